@@ -0,0 +1,249 @@
+import numpy as np
+
+# NumPy geometry kernel shared by the tools. Works on plain float arrays and
+# has no Blender imports, so it can be used and benchmarked outside Blender.
+#
+# Segments are (N, 2, 2) arrays of start/end points, polygons are (M, 2) arrays.
+
+def as_points(points):
+    return np.asarray(points, dtype=np.float64).reshape(-1, 2)
+
+def as_segments(segments):
+    return np.asarray(segments, dtype=np.float64).reshape(-1, 2, 2)
+
+def segment_bounds(segments):
+    # (N, 4) minx, miny, maxx, maxy
+    segments = as_segments(segments)
+    return np.concatenate( (segments.min(axis=1), segments.max(axis=1)), axis=1)
+
+def bounds_overlap(bounds, box):
+    # mask of the (N, 4) bounds that overlap box
+    bounds = np.asarray(bounds, dtype=np.float64).reshape(-1, 4)
+    return (bounds[:, 0] <= box[2]) & (bounds[:, 2] >= box[0]) & (bounds[:, 1] <= box[3]) & (bounds[:, 3] >= box[1])
+
+def points_in_bounds(points, box):
+    points = as_points(points)
+    return (points[:, 0] >= box[0]) & (points[:, 0] <= box[2]) & (points[:, 1] >= box[1]) & (points[:, 1] <= box[3])
+
+def segment_intersections(a0, a1, b0, b1):
+    # element wise intersection of segments a0-a1 with b0-b1, arrays broadcast
+    # against each other. Returns (mask, points, u) with u the parameter along a.
+    # Parallel and collinear pairs are reported as not intersecting, callers
+    # that care about collinear touching end points use segments_parallel.
+    a0 = np.asarray(a0, dtype=np.float64)
+    a1 = np.asarray(a1, dtype=np.float64)
+    b0 = np.asarray(b0, dtype=np.float64)
+    b1 = np.asarray(b1, dtype=np.float64)
+
+    s10 = a1 - a0
+    s32 = b1 - b0
+    s20 = b0 - a0
+
+    d = s10[..., 0] * s32[..., 1] - s10[..., 1] * s32[..., 0]
+    parallel = d == 0
+    dd = np.where(parallel, 1.0, d)
+
+    u = (s20[..., 0] * s32[..., 1] - s20[..., 1] * s32[..., 0]) / dd
+    v = (s20[..., 0] * s10[..., 1] - s20[..., 1] * s10[..., 0]) / dd
+
+    mask = ~parallel & (u >= 0) & (u <= 1) & (v >= 0) & (v <= 1)
+    points = a0 + s10 * u[..., None]
+
+    return mask, points, u
+
+def segments_parallel(a0, a1, b0, b1):
+    a0 = np.asarray(a0, dtype=np.float64)
+    s10 = np.asarray(a1, dtype=np.float64) - a0
+    s32 = np.asarray(b1, dtype=np.float64) - np.asarray(b0, dtype=np.float64)
+    return s10[..., 0] * s32[..., 1] - s10[..., 1] * s32[..., 0] == 0
+
+def ray_segment_hits(origin, direction, segments):
+    # distances along the ray (origin + t * direction, t >= 0) to every segment,
+    # inf where the segment is missed
+    segments = as_segments(segments)
+    o = np.asarray(origin, dtype=np.float64)
+    r = np.asarray(direction, dtype=np.float64)
+
+    p = segments[:, 0]
+    s = segments[:, 1] - p
+    op = p - o
+
+    d = r[0] * s[:, 1] - r[1] * s[:, 0]
+    parallel = d == 0
+    dd = np.where(parallel, 1.0, d)
+
+    t = (op[:, 0] * s[:, 1] - op[:, 1] * s[:, 0]) / dd
+    u = (op[:, 0] * r[1] - op[:, 1] * r[0]) / dd
+
+    hit = ~parallel & (t >= 0) & (u >= 0) & (u <= 1)
+    return np.where(hit, t, np.inf)
+
+def polygon_edges(polygons):
+    # edges of all polygons concatenated, with the polygon index of every edge
+    starts = []
+    ends = []
+    owners = []
+    for idx, poly in enumerate(polygons):
+        poly = as_points(poly)
+        if len(poly) == 0:
+            continue
+        starts.append(poly)
+        ends.append(np.roll(poly, -1, axis=0))
+        owners.append(np.full(len(poly), idx))
+    if not starts:
+        return np.empty( (0, 2) ), np.empty( (0, 2) ), np.empty(0, dtype=np.int64)
+    return np.concatenate(starts), np.concatenate(ends), np.concatenate(owners)
+
+def points_in_polygons(points, polygons, chunk = 1 << 20):
+    # crossing number test of many points against many polygons, (P, M) bool.
+    # Same rules as the scalar pointInPoly loop, points are processed in chunks
+    # so P * edges stays bounded in memory
+    points = as_points(points)
+    p1, p2, owners = polygon_edges(polygons)
+
+    result = np.zeros( (len(points), len(polygons)), dtype=bool)
+    if len(p1) == 0 or len(points) == 0:
+        return result
+
+    used, offsets = np.unique(owners, return_index=True)
+
+    ymin = np.minimum(p1[:, 1], p2[:, 1])
+    ymax = np.maximum(p1[:, 1], p2[:, 1])
+    xmax = np.maximum(p1[:, 0], p2[:, 0])
+    vertical = p1[:, 0] == p2[:, 0]
+    dx = p2[:, 0] - p1[:, 0]
+    dy = p2[:, 1] - p1[:, 1]
+    dy = np.where(dy == 0, 1.0, dy) # horizontal edges never pass the y test
+
+    step = max(1, chunk // len(p1))
+    for start in range(0, len(points), step):
+        x = points[start:start + step, 0:1]
+        y = points[start:start + step, 1:2]
+
+        xinters = (y - p1[:, 1]) * dx / dy + p1[:, 0]
+        crossing = (y > ymin) & (y <= ymax) & (x <= xmax) & (vertical | (x <= xinters))
+
+        # edges are grouped per polygon, sum the crossings of every group
+        counts = np.add.reduceat(crossing.view(np.uint8), offsets, axis=1, dtype=np.int64)
+        result[start:start + step, used] = counts % 2 == 1
+
+    return result
+
+def point_in_polygons(point, polygons):
+    # one point against many polygons, bounds are checked first
+    x, y = point
+    inside = np.zeros(len(polygons), dtype=bool)
+    candidates = []
+    for idx, poly in enumerate(polygons):
+        poly = as_points(poly)
+        if len(poly) and poly[:, 0].min() <= x <= poly[:, 0].max() and poly[:, 1].min() <= y <= poly[:, 1].max():
+            candidates.append(idx)
+    if candidates:
+        inside[candidates] = points_in_polygons( [point], [polygons[i] for i in candidates])[0]
+    return inside
+
+def point_in_polygon(point, polygon):
+    return bool(points_in_polygons( [point], [polygon])[0, 0])
+
+def project_to_region(co, perspective_matrix, width, height):
+    # 3D points to region pixel coordinates with the view's perspective
+    # matrix, the vectorized location_3d_to_region_2d. Returns (points, w),
+    # points with w <= 0 are behind the view
+    co = np.asarray(co, dtype=np.float64).reshape(-1, 3)
+    m = np.asarray(perspective_matrix, dtype=np.float64).reshape(4, 4)
+
+    clip = co @ m[:, :3].T + m[:, 3]
+    w = clip[:, 3]
+    ww = np.where(w > 0, w, 1.0)
+
+    points = np.empty( (len(co), 2) )
+    points[:, 0] = (width / 2) + (width / 2) * (clip[:, 0] / ww)
+    points[:, 1] = (height / 2) + (height / 2) * (clip[:, 1] / ww)
+    return points, w
+
+def perspective_correct(t, wa, wb):
+    # parameter along a 3D segment of the point at screen parameter t along
+    # its projection, wa / wb the clip w of the end points
+    t = np.asarray(t, dtype=np.float64)
+    d = t * wa + (1 - t) * wb
+    return np.where(d != 0, t * wa / np.where(d != 0, d, 1.0), t)
+
+def closest_on_segments(point, a, b):
+    # closest point to point on every segment a-b, as (points, t, distances)
+    a = as_points(a)
+    b = as_points(b)
+    ab = b - a
+    ll = (ab ** 2).sum(axis=1)
+    t = np.clip( ( (np.asarray(point, dtype=np.float64) - a) * ab).sum(axis=1) / np.where(ll > 0, ll, 1.0), 0, 1)
+    points = a + ab * t[:, None]
+    return points, t, np.sqrt( ( (points - point) ** 2).sum(axis=1))
+
+if __name__ == "__main__":
+    # micro benchmark against the scalar crossing number loop on 100k edges
+    import time
+
+    def pointInPoly(x,y,poly):
+        inside = False
+        p1x, p1y = poly[0]
+        n = len(poly)
+        for i in range(n+1):
+            p2x, p2y = poly[i % n]
+            if y > min(p1y, p2y):
+                if y <= max(p1y, p2y):
+                    if x <= max(p1x, p2x):
+                        if p1y != p2y:
+                            xinters = (y-p1y) * (p2x-p1x)/(p2y-p1y)+p1x
+                        if p1x == p2x or x <= xinters:
+                            inside = not inside
+            p1x, p1y = p2x, p2y
+        return inside
+
+    rng = np.random.default_rng(0)
+
+    n = 100000
+    a = np.linspace(0, 2 * np.pi, n, endpoint=False)
+    r = 1 + 0.1 * rng.random(n)
+    poly = np.stack( (np.cos(a) * r, np.sin(a) * r), axis=1)
+    queries = rng.uniform(-1.2, 1.2, (20, 2))
+
+    t = time.perf_counter()
+    expected = [pointInPoly(x, y, poly.tolist()) for x, y in queries]
+    t_scalar = time.perf_counter() - t
+
+    t = time.perf_counter()
+    result = points_in_polygons(queries, [poly])[:, 0]
+    t_vector = time.perf_counter() - t
+
+    assert list(result) == expected
+    print("point in polygon, %d queries x %d edges: %.1f ms scalar, %.1f ms numpy (%.0fx)" %
+        (len(queries), n, t_scalar * 1000, t_vector * 1000, t_scalar / t_vector))
+
+    segments = rng.uniform(-1, 1, (n, 2, 2))
+
+    t = time.perf_counter()
+    hits = []
+    for (x1, y1), (x2, y2) in segments.tolist():
+        s = (x2 - x1, y2 - y1)
+        d = s[1]
+        if d != 0:
+            u = -y1 / d
+            tt = x1 + s[0] * u
+            if 0 <= u <= 1 and tt >= 0:
+                hits.append(tt)
+    t_scalar = time.perf_counter() - t
+
+    t = time.perf_counter()
+    dist = ray_segment_hits( (0, 0), (1, 0), segments)
+    t_vector = time.perf_counter() - t
+
+    assert np.count_nonzero(np.isfinite(dist)) == len(hits)
+    print("ray vs %d segments: %.1f ms scalar, %.1f ms numpy (%.0fx)" %
+        (n, t_scalar * 1000, t_vector * 1000, t_scalar / t_vector))
+
+    a0 = rng.uniform(-1, 1, (n, 2))
+    a1 = rng.uniform(-1, 1, (n, 2))
+
+    t = time.perf_counter()
+    mask, points, u = segment_intersections(a0[0], a1[0], a0, a1)
+    t_vector = time.perf_counter() - t
+    print("segment vs %d segments: %.1f ms numpy, %d hits" % (n, t_vector * 1000, np.count_nonzero(mask)))
@@ -1,8 +1,14 @@
 import bpy
 import gpu
+from gpu_extras.batch import batch_for_shader
 from bpy_extras import view3d_utils
-from mathutils import Vector
 from bpy.props import IntProperty, FloatProperty, BoolProperty, EnumProperty
+import numpy as np
+
+from . import geometry_kernel
+from . import point_align
+from . import selection_query
+from .spatial_index import PointGrid
 
 def to3d(context, pos2d): # helper function to convert 2d point to 3d
     return view3d_utils.region_2d_to_location_3d(context.region, context.space_data.region_3d, 
@@ -11,19 +17,21 @@ def to3d(context, pos2d): # helper function to convert 2d point to 3d
 def to2d(context, pos3d): # helper function to convert 3d point to 2d
     return view3d_utils.location_3d_to_region_2d(context.region, context.space_data.region_3d, pos3d)
 
-def get_selected_points(context):
-    if context.active_object.type != 'GPENCIL':
-        return []
-    gp = context.active_object.data
-    return [p
-        for lr in gp.layers
-            if not lr.lock and not lr.hide  #Respect layer locking and visibility
-                for fr in ([fr for fr in lr.frames if fr.select or fr == lr.active_frame] if gp.use_multiedit else [lr.active_frame])    #Respect multiframe editing settings
-                    for s in fr.strokes
-                        if s.select
-                            for p in s.points
-                                if p.select]
-
+def draw_callback_line(self, context):
+    # anchored first point of the line and the line to the mouse
+    if self.anchor is None:
+        return
+    shader = gpu.shader.from_builtin('UNIFORM_COLOR')
+    shader.uniform_float("color", (1.0, 0.6, 0.0, 1.0))
+    gpu.state.blend_set('ALPHA')
+    gpu.state.point_size_set(8)
+    batch_for_shader(shader, 'POINTS', {"pos": [self.anchor]}).draw(shader)
+    gpu.state.line_width_set(1.0)
+    batch_for_shader(shader, 'LINES', {"pos": [self.anchor, self.mouse]}).draw(shader)
+
+    # restore opengl defaults
+    gpu.state.point_size_set(1.0)
+    gpu.state.blend_set('NONE')
 
 class alignOperator(bpy.types.Operator):
     arg: bpy.props.IntProperty()
@@ -32,8 +40,9 @@ class alignOperator(bpy.types.Operator):
     bl_options = {'REGISTER', 'UNDO'}
     
     selectedPoint = None
-    selected_points = []
     align : IntProperty(default=0)
+    pick_radius : IntProperty(name = "Pick Radius", description = "Distance in pixels to pick a selected point", default = 10, min = 1, subtype = 'PIXEL')
+    grid_size : FloatProperty(name = "Grid Size", description = "Spacing of the grid points are snapped to", default = 0.1, min = 0.0001)
 
     @classmethod
     def description(cls, context, properties):
@@ -42,6 +51,14 @@ class alignOperator(bpy.types.Operator):
                 return "Align selected points horizontally to clicked selected point.\nSHIFT to keep relative offsets"
             case 2: 
                 return "Align selected points vertically to clicked selected point.\nSHIFT to keep relative offsets"
+            case 3:
+                return "Space selected points evenly between the leftmost and rightmost one"
+            case 4:
+                return "Space selected points evenly between the lowest and highest one"
+            case 5:
+                return "Align selected points to the line through two clicked selected points"
+            case 6:
+                return "Snap selected points to the grid"
             
         return "Converge selected points to clicked selected point.\nSHIFT to keep relative offsets"
 
@@ -54,65 +71,107 @@ class alignOperator(bpy.types.Operator):
         self.shift_key = event.shift
         
         if event.type == "MOUSEMOVE":
-            pos = view3d_utils.region_2d_to_location_3d(context.region, context.space_data.region_3d, 
-                (event.mouse_region_x, event.mouse_region_y), (0,0,0))
-
-            self.selectedPoint = None
-            gp = context.active_object.data
-            
-            for lr in gp.layers:
-                if not lr.lock and not lr.hide:  #Respect layer locking and visibility
-                    for fr in ([fr for fr in lr.frames if fr.select or fr == lr.active_frame] if gp.use_multiedit else [lr.active_frame]):    #Respect multiframe editing settings
-                        for s in fr.strokes:
-                                for p in s.points:
-                                    v = Vector((pos[0] - p.co[0], 0, pos[2] - p.co[2]))
-                                    if v.length < 0.04:
-                                        self.selectedPoint = p
-                                        break
-                                                        
-
-            if self.selectedPoint:
+            self.mouse = (event.mouse_region_x, event.mouse_region_y)
+            if self.anchor is not None:
+                context.area.tag_redraw()
+            grid, ids = self.pick_grid
+            k = grid.nearest(event.mouse_region_x, event.mouse_region_y, self.pick_radius)
+            self.selectedPoint = None if k is None else int(ids[k])
+
+            if self.selectedPoint is not None:
                context.window.cursor_modal_set("CROSSHAIR")
             else:
                 context.window.cursor_modal_set("PAINT_CROSS")
 
+        elif event.type == "LEFTMOUSE" and self.align == 5:
+            if event.value != 'PRESS':
+                return {'RUNNING_MODAL'}
+            if self.selectedPoint is None:
+                self.finish(context)
+                return {'CANCELLED'}
+            if self.lineStart is None or self.lineStart == self.selectedPoint:
+                self.anchorLine(context, self.selectedPoint)
+                return {'RUNNING_MODAL'}
+            
+            self.finish(context)
+            self.apply(context, point_align.align_to_line(self.co, self.co[self.lineStart], self.co[self.selectedPoint]))
+            return {'FINISHED'}
+
         elif event.type == "LEFTMOUSE":
             context.window.cursor_modal_restore()
             context.window.cursor_modal_restore()
 
-            if self.selectedPoint:
-                if self.shift_key:
-                    vOffset = Vector((99999, 0, 99999))
-                    for p in self.selected_points:
-                        if p == self.selectedPoint: continue
-                        if self.align == 1:
-                            v = Vector((self.selectedPoint.co[0] - p.co[0], 0, 0))
-                        elif self.align == 2:
-                            v = Vector((0, 0, self.selectedPoint.co[2] - p.co[2]))
-                        else:
-                            v = Vector((self.selectedPoint.co[0] - p.co[0], 0, self.selectedPoint.co[2] - p.co[2]))
-                        if v.length < vOffset.length:
-                            vOffset = v
-
-                for p in self.selected_points:
-                    if p == self.selectedPoint: continue
-                    if self.align == 0 or self.align == 1:
-                        p.co[0] = self.selectedPoint.co[0] if not self.shift_key else p.co[0] + vOffset.x
-                    if self.align == 0 or self.align == 2:
-                        p.co[2] = self.selectedPoint.co[2] if not self.shift_key else p.co[2] + vOffset.z
-                    
+            if self.selectedPoint is not None:
+                axes = (point_align.BOTH, point_align.HORIZONTAL, point_align.VERTICAL)[self.align]
+                self.apply(context, point_align.align(self.co, self.co[self.selectedPoint], axes,
+                    relative = self.shift_key, exclude = self.selectedPoint))
                 return {'FINISHED'}
             return {'CANCELLED'}
             
         elif event.type in {'RIGHTMOUSE', 'ESC'}:
-            context.window.cursor_modal_restore()
+            self.finish(context)
 
             return {'CANCELLED'}
         
         return {'RUNNING_MODAL'}    
     
+    def pick_index(self, context):
+        # selected points in region pixels, the selection and the view don't
+        # change while the operator runs so it is built once
+        region = context.region
+        points, w = geometry_kernel.project_to_region(self.co, context.space_data.region_3d.perspective_matrix, region.width, region.height)
+        ids = (w > 0).nonzero()[0]
+        r = self.pick_radius
+        return PointGrid(points[ids], r, (-r, -r, region.width + r, region.height + r)), ids
+
+    def anchorLine(self, context, index):
+        # first point of the line, drawn until the second one is clicked
+        self.lineStart = index
+        points, w = geometry_kernel.project_to_region(self.co[index], context.space_data.region_3d.perspective_matrix, context.region.width, context.region.height)
+        self.anchor = tuple(points[0])
+        if self._handle is None:
+            self._handle = bpy.types.SpaceView3D.draw_handler_add(draw_callback_line, (self, context), 'WINDOW', 'POST_PIXEL')
+        context.area.tag_redraw()
+        self.report({'INFO'}, "Line start set, click the second point")
+
+    def finish(self, context):
+        if self._handle is not None:
+            bpy.types.SpaceView3D.draw_handler_remove(self._handle, 'WINDOW')
+            self._handle = None
+            context.area.tag_redraw()
+        context.window.cursor_modal_restore()
+
+    def apply(self, context, co):
+        # foreach_set doesn't send updates, tag the data for the depsgraph
+        self.selection.write(self.gp, 'co', co, self.strokes)
+        self.co = co
+        self.gp.update_tag()
+        context.area.tag_redraw()
+
     def execute(self, context):
-        self.selected_points = get_selected_points(context)
+        self.selection = selection_query.query(context)
+        if not self.selection:
+            return {'CANCELLED'}
+        
+        # all selected points in one array, frame numbers keep multiframe
+        # copies apart when distributing
+        self.gp = context.active_object.data
+        self.strokes = self.selection.stroke_objects(self.gp)
+        self.co = self.selection.read(self.gp, 'co', self.strokes).astype(np.float64)
+        
+        if self.align in (3, 4):
+            self.apply(context, point_align.distribute(self.co, 0 if self.align == 3 else 2, self.selection.point_frame_numbers()))
+            return {'FINISHED'}
+        if self.align == 6:
+            self.apply(context, point_align.snap_to_grid(self.co, self.grid_size))
+            return {'FINISHED'}
+        
+        self.selectedPoint = None
+        self.lineStart = None
+        self.anchor = None
+        self.mouse = (0, 0)
+        self._handle = None
+        self.pick_grid = self.pick_index(context)
         context.window.cursor_modal_set("PAINT_CROSS")
         context.window_manager.modal_handler_add(self)
         
@@ -131,6 +190,11 @@ class pointAlignMenu(bpy.types.Menu):
         self.layout.operator(alignOperator.bl_idname, text="Vertical").align=2
         self.layout.separator()
         self.layout.operator(alignOperator.bl_idname, text="Converge").align=0
+        self.layout.operator(alignOperator.bl_idname, text="To Line").align=5
+        self.layout.separator()
+        self.layout.operator(alignOperator.bl_idname, text="Distribute Horizontal").align=3
+        self.layout.operator(alignOperator.bl_idname, text="Distribute Vertical").align=4
+        self.layout.operator(alignOperator.bl_idname, text="Snap to Grid").align=6
     
     
 def align_menu_func(self, context):
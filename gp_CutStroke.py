@@ -15,15 +15,18 @@ import blf
 import gpu
 from gpu_extras.batch import batch_for_shader
 from bpy_extras import view3d_utils
+from bpy.props import BoolProperty, EnumProperty
 from mathutils import Vector
-import mathutils
+import numpy as np
+
+from . import stroke_io
+from . import geometry_kernel
+from .spatial_index import SegmentIndex
 
 def draw_callback_px(self, context):
     
-    if self.first:
-        lines = []
-        lines.append(self.first)
-        lines.append(self.mousepos)
+    if self.path and self.mousepos:
+        lines = self.path + [self.mousepos]
         # 50% alpha, 2 pixel width line
         shader = gpu.shader.from_builtin('UNIFORM_COLOR')
         gpu.state.blend_set('ALPHA')
@@ -37,11 +40,96 @@ def draw_callback_px(self, context):
         gpu.state.blend_set('NONE')
 
 
+def knife_segments(path):
+    # (k, 2, 2) segments of a knife polyline
+    path = geometry_kernel.as_points(path)
+    return np.stack( (path[:-1], path[1:]), axis=1)
+
+def cut_stroke(frame, stroke, knife, split = False, segments = None, xz = None):
+    # insert a point wherever a knife segment crosses a segment of the stroke,
+    # all crossings are found first and spliced in with one bulk write.
+    # knife: (k, 2, 2) knife segments, segments: candidate segment indices
+    # (point i to i + 1) from a SegmentIndex, xz: the stroke's points if
+    # already known. Returns the number of cuts
+    cnt = len(stroke.points)
+    knife = geometry_kernel.as_segments(knife)
+    if cnt <= 1 or len(knife) == 0:
+        return 0
+
+    if xz is None:
+        xz = stroke_io.read_points(stroke.points, ['co'])['co'][:, [0, 2]]
+
+    # segment k runs from point k - 1 to point k, the cyclic segment ends at cnt
+    if segments is None:
+        x = np.arange(1, cnt + 1 if stroke.use_cyclic else cnt)
+    else:
+        x = np.asarray(segments, dtype=np.int64) + 1
+    s0 = xz[x - 1]
+    s1 = xz[x % cnt]
+
+    # stroke segment x knife segment pairs with overlapping bounds, then all
+    # of them intersected in one pass
+    sb = np.concatenate( (np.minimum(s0, s1), np.maximum(s0, s1)), axis=1)
+    kb = geometry_kernel.segment_bounds(knife)
+    near = (sb[:, None, 0] <= kb[None, :, 2]) & (sb[:, None, 2] >= kb[None, :, 0]) & \
+        (sb[:, None, 1] <= kb[None, :, 3]) & (sb[:, None, 3] >= kb[None, :, 1])
+    i, j = near.nonzero()
+    hit, points, u = geometry_kernel.segment_intersections(s0[i], s1[i], knife[j, 0], knife[j, 1])
+
+    # order the cuts along the stroke, a knife vertex on a segment hits twice
+    i, points, u = i[hit], points[hit], u[hit]
+    order = np.lexsort( (u, i) )
+    i, points = i[order], points[order]
+    if len(i) > 1:
+        keep = np.ones(len(i), dtype=bool)
+        keep[1:] = (i[1:] != i[:-1]) | (points[1:] != points[:-1]).any(axis=1)
+        i, points = i[keep], points[keep]
+
+    pdx = x[i]
+    if len(pdx) == 0:
+        return 0
+
+    arrays = stroke_io.read_points(stroke.points)
+
+    # new points take their attributes from the point after them
+    values = stroke_io.take_points(arrays, pdx % cnt)
+    values['co'] = stroke_io.xz_to_co(points)
+    values['select'] = np.ones(len(pdx), dtype=bool)
+
+    arrays = stroke_io.insert_points(arrays, pdx, values)
+
+    if not split:
+        stroke_io.write_points(stroke.points, arrays)
+        return len(pdx)
+
+    # index of every inserted point in the spliced arrays
+    cuts = pdx + np.arange(len(pdx))
+    pieces = stroke_io.split_points(len(arrays['co']), cuts, stroke.use_cyclic)
+
+    # every piece is a new stroke and the original is removed, shrinking it
+    # in place would pop its points one at a time
+    offsets = np.zeros(len(pieces) + 1, dtype=np.int64)
+    np.cumsum( [len(piece) for piece in pieces], out=offsets[1:])
+    values = stroke_io.take_points(arrays, np.concatenate(pieces))
+    for newStroke in stroke_io.new_strokes(frame, values.pop('co'), offsets, **values):
+        stroke_io.copy_stroke_settings(stroke, newStroke)
+    frame.strokes.remove(stroke)
+
+    return len(pdx)
+
 class CutStrokeOperator(bpy.types.Operator):
-    """Cut visible strokes on the active layer"""
+    """Cut visible strokes on the active layer.
+SHIFT on the second click to also split the strokes at the cut points.
+Polyline knife: click to add corners, drag to draw freehand, ENTER or SPACE to cut"""
     bl_idname = "view3d.cutstroke_operator"
     bl_label = "Cut strokes Operator"
 
+    split_strokes : BoolProperty(name = "Split Strokes", description = "Split strokes at the cut points", default = False)
+    knife : EnumProperty(name = "Knife", description = "Shape of the knife",
+        items = (('LINE', "Line", "Cut along a single line"),
+            ('POLYLINE', "Polyline", "Cut along a path of clicked and freehand drawn segments")),
+        default = 'LINE')
+
     @classmethod
     def poll(self, context):
         return (context.mode == 'SCULPT_GPENCIL' or context.mode == 'EDIT_GPENCIL')
@@ -49,92 +137,98 @@ class CutStrokeOperator(bpy.types.Operator):
     def modal(self, context, event):
         context.area.tag_redraw()
         
-        if event.type in {'RIGHTMOUSE', 'ESC'}:
+        if event.type == 'ESC' and len(self.path) > 1:
+            self.path = []
+            self.drawing = False
+
+        elif event.type in {'RIGHTMOUSE', 'ESC'}:
             context.window.cursor_modal_restore()
             bpy.types.SpaceView3D.draw_handler_remove(self._handle, 'WINDOW')
             return {'FINISHED'}
             
         elif event.type == 'MOUSEMOVE':
             self.mousepos = (event.mouse_region_x, event.mouse_region_y)
+            # freehand, add a corner every few pixels while the button is held
+            if self.drawing and (Vector(self.mousepos) - Vector(self.path[-1])).length >= 4:
+                self.path.append(self.mousepos)
+
+        elif event.type in {'RET', 'SPACE'} and event.value == 'PRESS' and self.knife == 'POLYLINE':
+            self.cut(context, self.path, self.split_strokes or event.shift)
+            self.path = []
 
         elif event.type == 'LEFTMOUSE':
-            if self.first == None:
-                self.first = (event.mouse_region_x, event.mouse_region_y)
+            pos = (event.mouse_region_x, event.mouse_region_y)
+
+            if self.knife == 'POLYLINE':
+                self.drawing = event.value == 'PRESS'
+                if not self.path or pos != self.path[-1]:
+                    self.path.append(pos)
                 return {'RUNNING_MODAL'}
 
-            self.last = (event.mouse_region_x, event.mouse_region_y)
-            
-            area = context.area
-            space = area.spaces[0]
-            
-            for region in area.regions:
-                if region.type == 'WINDOW':
-                    break
-                
-            pt1 = view3d_utils.region_2d_to_location_3d(context.region, context.space_data.region_3d, 
-                (self.first[0], self.first[1]), (0,0,0))
-            pt2 = view3d_utils.region_2d_to_location_3d(context.region, context.space_data.region_3d, 
-                (self.last[0], self.last[1]), (0,0,0))
-                
-            lineA_p1 = Vector((pt1[0], pt1[2]))
-            lineA_p2 = Vector((pt2[0], pt2[2]))
-                
-            gp = context.active_object    
-            
-            strokes = [s for lr in gp.data.layers for s in lr.active_frame.strokes]
-            
-            for stroke in strokes:
-                cnt = len(stroke.points)
-                if cnt <= 1: continue
-            
-                x = list(range(cnt if stroke.use_cyclic else cnt - 1, 0, -1))
-                
-                for idx in range(len(x)):
-                    p1_idx = x[idx] % cnt
-                    p2_idx = x[idx] - 1
-                    
-                    lineB_p1 = Vector((stroke.points[p1_idx].co[0], stroke.points[p1_idx].co[2]))
-                    lineB_p2 = Vector((stroke.points[p2_idx].co[0], stroke.points[p2_idx].co[2]))
-
-                    intersect_point = mathutils.geometry.intersect_line_line_2d(lineA_p1, lineA_p2, lineB_p1, lineB_p2)
-                    
-                    pdx = x[idx]
-                    
-                    if intersect_point:
-                        
-                        stroke.points.add(1)
-                    
-                        for i in range( len(stroke.points) - 1, pdx, -1):
-                            stroke.points[i].uv_rotation = stroke.points[i - 1].uv_rotation
-                            stroke.points[i].uv_fill = stroke.points[i - 1].uv_fill
-                            stroke.points[i].uv_factor = stroke.points[i - 1].uv_factor
-                            
-                            stroke.points[i].pressure = stroke.points[i - 1].pressure
-                            stroke.points[i].strength = stroke.points[i - 1].strength
-                            stroke.points[i].vertex_color = stroke.points[i - 1].vertex_color
-                            
-                            stroke.points[i].co[0] = stroke.points[i - 1].co[0]
-                            stroke.points[i].co[1] = stroke.points[i - 1].co[1]
-                            stroke.points[i].co[2] = stroke.points[i - 1].co[2]
-                            stroke.points[i].select = stroke.points[i - 1].select
-                        
-                        stroke.points[pdx].pressure = stroke.points[pdx].pressure
-                        stroke.points[pdx].strength = stroke.points[pdx].strength
-                        stroke.points[pdx].vertex_color = stroke.points[pdx].vertex_color
-                        stroke.points[pdx].uv_rotation = stroke.points[pdx].uv_rotation
-                        stroke.points[pdx].uv_fill = stroke.points[pdx].uv_fill
-                        stroke.points[pdx].uv_factor = stroke.points[pdx].uv_factor
-                        
-                        stroke.points[pdx].co[0] = intersect_point.x
-                        stroke.points[pdx].co[1] = 0
-                        stroke.points[pdx].co[2] = intersect_point.y
-                        stroke.points[pdx].select = True
-
-                                            
-            self.first = None
+            if not self.path:
+                self.path = [pos]
+                return {'RUNNING_MODAL'}
+
+            self.cut(context, self.path + [pos], self.split_strokes or event.shift)
+            self.path = []
             
         return {'RUNNING_MODAL'}
 
+    def cut(self, context, path, split):
+        if len(path) < 2:
+            return
+
+        # knife path in the drawing plane
+        knife = knife_segments( [self.to_xz(context, p) for p in path] )
+
+        gp = context.active_object    
+        
+        index = self.segment_index(gp)
+        layers = gp.data.layers
+
+        # highest stroke index first, removing a split stroke only shifts the
+        # strokes already cut
+        cuts = 0
+        for key, segments in sorted(index.query_boxes(geometry_kernel.segment_bounds(knife)).items(), reverse = True):
+            frame = layers[key[0]].active_frame
+            stroke = frame.strokes[key[1]]
+            n = cut_stroke(frame, stroke, knife, split, segments, index.lines[key][0])
+            if n and not split:
+                self.index_stroke(index, key[0], key[1], stroke)
+            cuts += n
+
+        if cuts and split:
+            # stroke indices moved, rebuilt on the next cut
+            self.index = None
+        if cuts:
+            bpy.ops.ed.undo_push(message = 'Cut strokes')
+
+    @staticmethod
+    def to_xz(context, pos):
+        pt = view3d_utils.region_2d_to_location_3d(context.region, context.space_data.region_3d, pos, (0,0,0))
+        return (pt[0], pt[2])
+
+    def segment_index(self, gp):
+        # segments of the strokes of every layer's active frame, built on the
+        # first cut and kept up to date as strokes are cut
+        frames = tuple(lr.active_frame.frame_number if lr.active_frame else None for lr in gp.data.layers)
+        if self.index is None or self.index_frames != frames:
+            lines = {}
+            for ldx, lr in enumerate(gp.data.layers):
+                if lr.active_frame:
+                    for sdx, stroke in enumerate(lr.active_frame.strokes):
+                        lines[(ldx, sdx)] = (self.stroke_xz(stroke), stroke.use_cyclic)
+            self.index = SegmentIndex.build(lines)
+            self.index_frames = frames
+        return self.index
+
+    @staticmethod
+    def stroke_xz(stroke):
+        return stroke_io.read_points(stroke.points, ['co'])['co'][:, [0, 2]]
+
+    def index_stroke(self, index, ldx, sdx, stroke):
+        index.insert( (ldx, sdx), self.stroke_xz(stroke), stroke.use_cyclic)
+
     def invoke(self, context, event):
         if context.area.type == 'VIEW_3D' and context.active_object.type == 'GPENCIL':
             # the arguments we pass the the callback
@@ -144,8 +238,11 @@ class CutStrokeOperator(bpy.types.Operator):
             self._handle = bpy.types.SpaceView3D.draw_handler_add(draw_callback_px, args, 'WINDOW', 'POST_PIXEL')
             context.window.cursor_modal_set("KNIFE")
 
-            self.first = None
+            self.path = []
+            self.drawing = False
             self.mousepos = None
+            self.index = None
+            self.index_frames = None
 
             context.window_manager.modal_handler_add(self)
             return {'RUNNING_MODAL'}
@@ -11,16 +11,40 @@ bl_info = {
 }
 
 import bpy
-import math
-import mathutils
+import gpu
+import time
+import numpy as np
 
-from mathutils import Vector
+from bpy.props import FloatProperty
+from bpy.app.handlers import persistent
+from gpu_extras.batch import batch_for_shader
 from bpy_extras import view3d_utils
 
+from . import planar_graph
+from . import geometry_kernel
+from . import stroke_io
+
 # mm = bpy.data.texts['gp_GeometryFill.py'].as_module()
 
 PREC = 4
 
+fill_timings = {} # seconds spent per stage of the last fillPoly call
+
+MAX_CACHED_FRAMES = 64
+
+fill_cache = {} # (object name, ((layer name, frame number), ...)) : Arrangement
+
+def lapTime(timings, stage, start):
+    now = time.perf_counter()
+    timings[stage] = timings.get(stage, 0) + now - start
+    return now
+
+def printTimings(timings):
+    total = sum(timings.values())
+    for stage, seconds in timings.items():
+        print("  %-8s %8.2f ms" % (stage, seconds * 1000))
+    print("  %-8s %8.2f ms" % ('total', total * 1000))
+
 def s2lin(x): # convert srgb to linear
     a = 0.055
     if x <= 0.04045:
@@ -29,13 +53,14 @@ def s2lin(x): # convert srgb to linear
         y = pow ( (x + a) * (1.0 / (1 + a)), 2.4)
     return y
 
-def createStroke(points):
+def createStrokes(polys, message = 'Added GeometryFill', arrangement = None):
+    # add a cyclic fill stroke per polygon with bulk point writes and a single undo step.
+    # The strokes are remembered by the arrangement so they aren't inserted into it
     C = bpy.context
 
     matIndex = C.active_object.active_material_index
     lineWidth = C.tool_settings.gpencil_paint.brush.size
 
-    clr = C.tool_settings.gpencil_paint.brush.color
     vertexColor = (0,0,0,1)
     
     clr = C.tool_settings.gpencil_paint.brush.color 
@@ -46,164 +71,191 @@ def createStroke(points):
     
     for frame in layer.frames:
         if frame.frame_number == C.scene.frame_current:
-            newStroke = frame.strokes.new()
-            newStroke.line_width = lineWidth
-            newStroke.material_index = matIndex
-            newStroke.vertex_color_fill = fillColor                        
-            newStroke.points.add( len(points ) )
-            for idx, pt in enumerate(points):
-                newStroke.points[idx].co = (pt[0], 0, pt[1])
-                newStroke.points[idx].vertex_color = vertexColor
-            newStroke.use_cyclic = True
-            newStroke.uv_scale = 1
-
-    bpy.ops.ed.undo_push(message = 'Added GeometryFill')
+            for points in polys:
+                co = stroke_io.xz_to_co(points)
+                if arrangement is not None:
+                    arrangement.fill_keys.add(stroke_io.co_key(co, True))
+                newStroke = stroke_io.new_stroke(frame, co, vertex_color = vertexColor)
+                newStroke.line_width = lineWidth
+                newStroke.material_index = matIndex
+                newStroke.vertex_color_fill = fillColor                        
+                newStroke.use_cyclic = True
+                newStroke.uv_scale = 1
+
+    bpy.ops.ed.undo_push(message = message)
+
+def createStroke(points, arrangement = None):
+    createStrokes([points], arrangement = arrangement)
 
 def isvclose(v1, v2):
     return (v2 - v1).length < 0.0001
 
-def pointInPoly(x,y,poly):
-    inside = False
-    p1x, p1y = poly[0]
-    n = len(poly)
-    for i in range(n+1):
-        p2x, p2y = poly[i % n]
-        if y > min(p1y, p2y):
-            if y <= max(p1y, p2y):
-                if x <= max(p1x, p2x):
-                    if p1y != p2y:
-                        xinters = (y-p1y) * (p2x-p1x)/(p2y-p1y)+p1x
-                    if p1x == p2x or x <= xinters:
-                        inside = not inside
-        p1x, p1y = p2x, p2y
-    return inside
-
-def getIntersections(edges, edge):
-    intersections = []
-    for edge1 in edges:
-        if edge1 == edge:
-            continue
-        ix = mathutils.geometry.intersect_line_line_2d(edge1[0], edge1[1], edge[0], edge[1])
-        if ix:
-            ix = (round(ix[0], PREC), round(ix[1], PREC) )
-            start_point = Vector(edge[0])
-            d = (start_point - Vector(ix)).length
-            intersections.append( (d, ix) )
-    intersections.sort()
-    return intersections
-
-def getConnectedEdges(edges, pt):
-    ret = []
-    for edge in edges:
-        if edge[0] == pt or (edge[1] == pt):
-            ret.append(edge)
-    return ret
+def strokeKey(stroke):
+    # content hash of a stroke's point buffer, cheap compared to reading points one by one
+    return stroke_io.co_key(stroke_io.read_points(stroke.points, ('co',))['co'], stroke.use_cyclic)
+
+def strokeEdges(stroke):
+    co = stroke_io.read_points(stroke.points, ('co',))['co'].tolist()
+
+    pts = [ ( round(v[0], PREC), round(v[2], PREC) ) for v in co]
+    if len(pts) < 2:
+        return []
+
+    edges = []
+    seen = set()
+    for pt1, pt2 in zip(pts, pts[1:]):
+        if (pt1, pt2) in seen or (pt2, pt1) in seen:
+            continue # don't add duplicate edges
+        seen.add( (pt1, pt2) )
+        edges.append( (pt1, pt2) )
+    if stroke.use_cyclic and pt2 != pts[0]:
+        edges.append( (pt2, pts[0]) )
+    return edges
+
+def getArrangement(context, gp, timings):
+    # cached arrangement of the edges of all strokes on the layers' active frames
+    t = time.perf_counter()
+
+    layers = [layer for layer in gp.data.layers if layer.active_frame]
+    key = (gp.name, tuple( (layer.info, layer.active_frame.frame_number) for layer in layers) )
+
+    arrangement = fill_cache.pop(key, None)
+    if arrangement is None:
+        arrangement = planar_graph.Arrangement(PREC)
+        arrangement.data_name = gp.data.name
+        arrangement.clean = False
+        arrangement.fill_keys = set() # fill strokes added by this tool, they follow existing edges
+    fill_cache[key] = arrangement # most recently used last
+
+    while len(fill_cache) > MAX_CACHED_FRAMES:
+        del fill_cache[next(iter(fill_cache))]
+
+    if arrangement.clean:
+        print("Using cached arrangement")
+        return arrangement
+
+    # only strokes whose content changed are (re)inserted
+    strokes = {}
+    keys = []
+    for layer in layers:
+        for stroke in layer.active_frame.strokes:
+            k = strokeKey(stroke)
+            if k in arrangement.fill_keys:
+                continue
+            strokes[k] = stroke
+            keys.append(k)
+
+    t = lapTime(timings, 'hash', t)
+
+    added, removed = arrangement.update(keys, lambda k: strokeEdges(strokes[k]))
+    arrangement.clean = True
+    print("Strokes: %d added, %d removed" % (added, removed))
+
+    t = lapTime(timings, 'update', t)
+
+    return arrangement
+
+@persistent
+def fillCacheDepsgraphUpdate(scene, depsgraph):
+    # stroke edits mark the cached arrangements of that object as dirty
+    names = {update.id.name for update in depsgraph.updates if update.is_updated_geometry}
+    if not names:
+        return
+    for (object_name, frames), arrangement in fill_cache.items():
+        if object_name in names or arrangement.data_name in names:
+            arrangement.clean = False
+
+@persistent
+def fillCacheUndo(scene, *args):
+    for arrangement in fill_cache.values():
+        arrangement.clean = False
+
+@persistent
+def fillCacheLoad(*args):
+    fill_cache.clear()
 
 def fillPoly(context, clicked_spot):
     print("-------------- START --------------")
 
+    timings = fill_timings
+    timings.clear()
+
     gp = bpy.context.active_object
 
-    PREC = 4
+    arrangement = getArrangement(context, gp, timings)
 
-    rawedges = []
-    polyedges = []
-                
-    # create list of raw edge data from Grease Pencil strokes        
-    for layer in gp.data.layers: 
-        for stroke in layer.active_frame.strokes:
-            pts = [ ( round(v.co[0], PREC), round(v.co[2], PREC) ) for v in stroke.points]
-            for pt1, pt2 in zip(pts, pts[1:]):
-                if rawedges.count( (pt1, pt2) ) > 0 or rawedges.count( (pt2, pt1) ) > 0:
-                    continue # don't add duplicate edges
-                rawedges.append( (pt1, pt2) )
-            if stroke.use_cyclic and pt2 != pts[0]:
-                rawedges.append( (pt2, pts[0]) )
-
-    # calculate edge intersections of raw edge data and create list of individual unique edges
-    for edge in rawedges:
-        intersections = getIntersections(rawedges, edge)
-        if len(intersections) == 0: # no shared point?
-            continue
-        elif len(intersections) == 1:
-            polyedges.append(edge)
-        else:
-            pt = edge[0]
-            for ix in intersections:
-                if ix[1] == pt or ix[1] == (pt[1], pt[0]):
-                    continue
-                newedge = ( pt, (ix[1][0], ix[1][1]) )
-                if polyedges.count( newedge) == 0 and polyedges.count( (newedge[1], newedge[0]) ) == 0:
-                    polyedges.append( newedge )
-                pt = ( ix[1][0], ix[1][1] )
+    # split edges traced into faces once, until the arrangement changes
+    t = time.perf_counter()
+    graph = arrangement.face_graph()
+    t = lapTime(timings, 'graph', t)
+
+    face = graph.locate(clicked_spot)
 
-    # remove duplicate edges if they exist
-    polyedges = list(dict.fromkeys(polyedges))
+    t = lapTime(timings, 'locate', t)
 
-    up_ray = ( (clicked_spot[0], clicked_spot[1]), (clicked_spot[0], 9999) )
+    if face:
+        createStroke(face.polygon, arrangement)
+        t = lapTime(timings, 'stroke', t)
 
-    closest_edges = []
+    print("Edges: %d raw, %d half edges, %d faces" % (len(arrangement.edges), len(graph.origin), len(graph.faces)))
+    printTimings(timings)
+    print("-------------- END --------------")
 
-    for edge in polyedges:
-        ix = mathutils.geometry.intersect_line_line_2d(edge[0], edge[1], up_ray[0], up_ray[1])
-        if ix:
-            closest_edges.append( [ (ix - Vector(clicked_spot)).length, edge ] ) 
+def fillAll(context, max_area = 0, lasso = None):
+    # fill every bounded face of the frame, optionally only faces smaller than
+    # max_area and/or with all their points inside the lasso polygon
+    print("-------------- START --------------")
 
-    closest_edges.sort()
+    timings = fill_timings
+    timings.clear()
 
-    for closest_edge in closest_edges:
-        print("Closest edge:" , closest_edge)
-        ev = Vector(closest_edge[1][1]) - Vector(closest_edge[1][0])
-        cv = Vector(closest_edge[1][1]) - Vector(clicked_spot) 
-        
-        clockwise = ev.cross(cv) >= 0
-        print("clockwise: ", clockwise)
-        
-        closed_poly = [ closest_edge[1][0] ]
-        
-        active_edge = closest_edge[1]
+    gp = context.active_object
 
-        while(1):
-            connected_edges = getConnectedEdges(polyedges, active_edge[1])
-            
-            if len(connected_edges) == 0:
-                break
-            
-            sorted = []
-            
-            for edge in connected_edges:
-                if edge == active_edge or (edge[1], edge[0]) == active_edge:
-                    continue
-                if edge[1] == active_edge[1]: edge = ( edge[1], edge[0] )
-                v1 = Vector(active_edge[1]) - Vector(active_edge[0])
-                v2 = Vector(active_edge[1]) - Vector(edge[1])
-                cross = v1.cross(v2)
-                angle = math.degrees(v1.angle(v2))
-                if clockwise:
-                    if cross < 0: angle = 360 - angle
-                else:
-                    if cross >= 0: angle = 360 - angle
-                sorted.append( [ angle, edge ] )
-            
-            sorted.sort()
-            
-            active_edge = sorted[0][1]
-            
-            closed_poly.append(active_edge[0])
+    arrangement = getArrangement(context, gp, timings)
 
-            if active_edge[1] == closed_poly[0]:
-                break
-            
-            if len(closed_poly) == 9999:
-                print("Break limit reached")
-                break
+    t = time.perf_counter()
+    graph = arrangement.face_graph()
+    t = lapTime(timings, 'graph', t)
 
-        if pointInPoly(clicked_spot[0], clicked_spot[1], closed_poly):
-            createStroke(closed_poly)
-            break
-            
+    faces = graph.bounded_faces()
+    if max_area > 0:
+        faces = [f for f in faces if f.area <= max_area]
+    if lasso and faces:
+        # all points of all faces tested against the lasso in one go
+        inside = geometry_kernel.points_in_polygons( [p for f in faces for p in f.polygon], [lasso])[:, 0]
+        offsets = np.cumsum( [0] + [len(f.polygon) for f in faces[:-1]] )
+        faces = [f for f, keep in zip(faces, np.logical_and.reduceat(inside, offsets)) if keep]
+
+    # big faces first so the faces of enclosed islands end up on top
+    faces.sort(key = lambda f: -f.area)
+
+    t = lapTime(timings, 'select', t)
+
+    if faces:
+        createStrokes([f.polygon for f in faces], 'Added GeometryFill All', arrangement)
+        t = lapTime(timings, 'stroke', t)
+
+    print("Filled %d of %d faces" % (len(faces), len(graph.bounded_faces())))
+    printTimings(timings)
     print("-------------- END --------------")
 
+    return len(faces)
+
+def draw_callback_px(self, context):
+    if len(self.lasso_path) < 2:
+        return
+
+    shader = gpu.shader.from_builtin('UNIFORM_COLOR')
+    gpu.state.blend_set('ALPHA')
+    gpu.state.line_width_set(2.0)
+    batch = batch_for_shader(shader, 'LINE_LOOP', {"pos": self.lasso_path})
+    shader.uniform_float("color", (0.0, 0.0, 0.0, 0.5))
+    batch.draw(shader)
+
+    # restore opengl defaults
+    gpu.state.line_width_set(1.0)
+    gpu.state.blend_set('NONE')
+
 #fillPoly(bpy.context, (0,0) )
 
 class gp_GeometryFillOperator(bpy.types.Operator):
@@ -239,6 +291,92 @@ class gp_GeometryFillOperator(bpy.types.Operator):
             self.report({'WARNING'}, "View3D not found, cannot run operator")
             return {'CANCELLED'}
 
+class gp_GeometryFillAllOperator(bpy.types.Operator):
+    """Fill all enclosed regions of the current frame.
+Left drag a lasso to only fill regions inside it, left click or ENTER to fill all.
+Right click/ESC to cancel"""
+    bl_idname = "quicktools.geometry_fill_all"
+    bl_label = "Grease Pencil Geometry Fill All"
+    bl_options = {'REGISTER'}
+
+    max_area : FloatProperty(name = "Max Area", description = "Only fill regions up to this area, 0 for no limit",
+        default = 0, min = 0)
+
+    @classmethod
+    def poll(self, context):
+        if not context.active_object: return False
+        return (context.active_object.type == 'GPENCIL')
+
+    def finish(self, context):
+        bpy.types.SpaceView3D.draw_handler_remove(self._handle, 'WINDOW')
+        context.window.cursor_modal_restore()
+        context.area.tag_redraw()
+
+    def modal(self, context, event):
+        context.area.tag_redraw()
+
+        if event.type == 'MOUSEMOVE':
+            if self.dragging:
+                self.lasso_path.append( (event.mouse_region_x, event.mouse_region_y) )
+
+        elif event.type == 'LEFTMOUSE':
+            if event.value == 'PRESS':
+                self.dragging = True
+                self.lasso_path = [ (event.mouse_region_x, event.mouse_region_y) ]
+                return {'RUNNING_MODAL'}
+
+            lasso = None
+            if len(self.lasso_path) > 2:
+                lasso = []
+                for p in self.lasso_path:
+                    pt = view3d_utils.region_2d_to_location_3d(context.region, context.space_data.region_3d, p, (0,0,0))
+                    lasso.append( (pt[0], pt[2]) )
+
+            self.finish(context)
+            self.report({'INFO'}, "Filled %d regions" % fillAll(context, self.max_area, lasso))
+            return {'FINISHED'}
+
+        elif event.type in {'SPACE', 'RET'} and event.value == 'RELEASE':
+            self.finish(context)
+            self.report({'INFO'}, "Filled %d regions" % fillAll(context, self.max_area))
+            return {'FINISHED'}
+
+        elif event.type in {'RIGHTMOUSE', 'ESC'}:
+            self.finish(context)
+            return {'CANCELLED'}
+
+        return {'RUNNING_MODAL'}
+
+    def execute(self, context):
+        self.report({'INFO'}, "Filled %d regions" % fillAll(context, self.max_area))
+        return {'FINISHED'}
+
+    def invoke(self, context, event):
+        if context.area.type == 'VIEW_3D' and context.active_object.type == 'GPENCIL':
+            self.lasso_path = []
+            self.dragging = False
+            self._handle = bpy.types.SpaceView3D.draw_handler_add(draw_callback_px, (self, context), 'WINDOW', 'POST_PIXEL')
+            context.window.cursor_modal_set("PAINT_BRUSH")
+            context.window_manager.modal_handler_add(self)
+            return {'RUNNING_MODAL'}
+        else:
+            self.report({'WARNING'}, "View3D not found, cannot run operator")
+            return {'CANCELLED'}
+
+def register():
+    bpy.app.handlers.depsgraph_update_post.append(fillCacheDepsgraphUpdate)
+    bpy.app.handlers.undo_post.append(fillCacheUndo)
+    bpy.app.handlers.redo_post.append(fillCacheUndo)
+    bpy.app.handlers.load_post.append(fillCacheLoad)
+
+def unregister():
+    for handlers, func in ( (bpy.app.handlers.depsgraph_update_post, fillCacheDepsgraphUpdate),
+        (bpy.app.handlers.undo_post, fillCacheUndo), (bpy.app.handlers.redo_post, fillCacheUndo),
+        (bpy.app.handlers.load_post, fillCacheLoad) ):
+        if func in handlers:
+            handlers.remove(func)
+    fill_cache.clear()
+
 """        
 class VIEW3D_PT_FillPolyPanel(bpy.types.Panel):
     bl_label = "Geometry Fill"
@@ -11,71 +11,134 @@ bl_info = {
 }
 
 import bpy
+import numpy as np
+
+from . import selection_query
+
+# valid range of every adjusted attribute, None for no upper limit
+RANGES = {
+    'strength' : (0.0, 1.0),
+    'pressure' : (0.0, None),
+    'hardness' : (0.0, 1.0),
+}
 
 class hardnessOperator(bpy.types.Operator):
     """Middle mouse to adjust selected strokes' hardness.
 Hold CTRL to adjust selected points' pressure(radius) instead.
 Hold SHIFT to adjust selected points' strength instead.
-Left click to apply"""
+Left click to apply, right click/ESC to cancel"""
     
     bl_idname = "stroke.hardness"
     bl_label = "Stroke Hardness"
     bl_options = {'REGISTER', 'UNDO'}
-    selected_points = []
+    selection = None
     
     @classmethod
     def poll(self, context):
         return (context.mode == 'SCULPT_GPENCIL' or context.mode == 'EDIT_GPENCIL')
     
-    def get_selected_points(self, context):
+    def snapshot(self, context):
+        # the adjusted attributes of the selection as arrays, the originals
+        # are kept for cancelling
         gp = context.active_object.data
-        return [p
-            for lr in gp.layers
-                if not lr.lock and not lr.hide  # Respect layer locking and visibility
-                    for fr in ([fr for fr in lr.frames if fr.select or fr == lr.active_frame] if gp.use_multiedit else [lr.active_frame])    #Respect multiframe editing settings
-                        for s in fr.strokes
-                            if s.select
-                                for p in s.points
-                                    if p.select]
+        self.strokes = self.selection.stroke_objects(gp)
+        self.values = {name : self.selection.read(gp, name, self.strokes) for name in ('strength', 'pressure')}
+        
+        # hardness is a stroke attribute, read and written per frame
+        groups = {}
+        for k, key in enumerate(zip(self.selection.stroke_layers.tolist(), self.selection.stroke_frames.tolist())):
+            groups.setdefault(key, []).append(k)
+        
+        self.frames = []
+        hardness = np.empty(len(self.strokes), dtype=np.float32)
+        for (li, fi), ks in groups.items():
+            frame = gp.layers[li].frames[fi]
+            data = np.empty(len(frame.strokes), dtype=np.float32)
+            frame.strokes.foreach_get('hardness', data)
+            ids = self.selection.stroke_ids[ks]
+            hardness[ks] = data[ids]
+            self.frames.append( (frame, data, ids, np.array(ks)) )
+        self.values['hardness'] = hardness
+        
+        self.original = {name : values.copy() for name, values in self.values.items()}
+        self.pending = {}
+    
+    def write(self, context, name):
+        values = self.values[name]
+        if name == 'hardness':
+            for frame, data, ids, ks in self.frames:
+                data[ids] = values[ks]
+                frame.strokes.foreach_set('hardness', data)
+        else:
+            self.selection.write(context.active_object.data, name, values, self.strokes)
+    
+    def tag(self, context):
+        # foreach_set doesn't send updates, tag the data for the depsgraph
+        context.active_object.data.update_tag()
+        context.area.tag_redraw()
+    
+    def apply(self, context):
+        # all wheel steps since the last update in one write per attribute
+        for name, delta in self.pending.items():
+            low, high = RANGES[name]
+            values = np.clip(self.values[name] + delta, low, high)
+            self.values[name] = values.astype(np.float32)
+            self.write(context, name)
+            
+            if len(values):
+                context.area.header_text_set("%s: min %.4f  mean %.4f  max %.4f" %
+                    (name.capitalize(), values.min(), values.mean(), values.max()))
+        if self.pending:
+            self.tag(context)
+        self.pending.clear()
+    
+    def finish(self, context):
+        context.window_manager.event_timer_remove(self._timer)
+        context.area.header_text_set(None)
+        context.window.cursor_modal_restore()
 
     def modal(self, context, event):
         if event.type == "WHEELUPMOUSE" or event.type == "WHEELDOWNMOUSE":
             incr = -0.01 if event.type == "WHEELDOWNMOUSE" else 0.01
 
             if event.shift:
-                incr *= 2
-                for p in self.selected_points:
-                    p.strength += incr
-                if p: context.area.header_text_set("Strength: %.4f" % p.strength)
+                name, incr = 'strength', incr * 2
             elif event.ctrl:
-                for p in self.selected_points:
-                    p.pressure += incr * 100
-                if p: context.area.header_text_set("Pressure: %.4f" % p.pressure)
+                name, incr = 'pressure', incr * 100
             else:
-                gp =  context.active_object.data
-                for lr in gp.layers:
-                    if not lr.lock and not lr.hide:
-                        frame_list = [fr for fr in lr.frames if fr.select] if gp.use_multiedit else [lr.active_frame]
-                        for fr in frame_list:
-                            for s in fr.strokes:
-                                if s.select:
-                                    s.hardness += incr
-                                    context.area.header_text_set("Hardness: %.4f" % s.hardness)
+                name = 'hardness'
+            self.pending[name] = self.pending.get(name, 0.0) + incr
+        
+        elif event.type == "TIMER":
+            if self.pending:
+                self.apply(context)
                     
         elif event.type == "LEFTMOUSE":
-            context.area.header_text_set(None)
-            context.window.cursor_modal_restore()
+            self.apply(context)
+            self.finish(context)
             return {'FINISHED'}
         
+        elif event.type in {'RIGHTMOUSE', 'ESC'}:
+            for name, values in self.original.items():
+                self.values[name] = values
+                self.write(context, name)
+            self.tag(context)
+            self.finish(context)
+            return {'CANCELLED'}
+        
         return {'RUNNING_MODAL'}    
 
     def execute(self, context):
-        self.selected_points = self.get_selected_points(context)    
+        self.selection = selection_query.query(context)
+        if not self.selection:
+            self.report({'INFO'}, "No selected points")
+            return {'CANCELLED'}
+        self.snapshot(context)
+        self._timer = context.window_manager.event_timer_add(0.02, window=context.window)
         context.window.cursor_modal_set("SCROLL_Y")
         context.window_manager.modal_handler_add(self)
         
         return {'RUNNING_MODAL'}
     
     def cancel(self, context):
-        context.area.header_text_set(None)
-        context.window.cursor_modal_restore()
+        self.finish(context)
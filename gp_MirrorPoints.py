@@ -4,20 +4,6 @@ from bpy_extras import view3d_utils
 from mathutils import Vector
 from bpy.props import IntProperty, FloatProperty, BoolProperty, EnumProperty
 
-def get_selected_points(context):
-    if context.active_object.type != 'GPENCIL':
-        return []
-    gp = context.active_object.data
-    return [p
-        for lr in gp.layers
-            if not lr.lock and not lr.hide  #Respect layer locking and visibility
-                for fr in ([fr for fr in lr.frames if fr.select or fr == lr.active_frame] if gp.use_multiedit else [lr.active_frame])    #Respect multiframe editing settings
-                    for s in fr.strokes
-                        if s.select
-                            for p in s.points
-                                if p.select]
-
-
 class mirrorOperator(bpy.types.Operator):
     arg: bpy.props.StringProperty()
     
@@ -15,10 +15,18 @@ import mathutils
 import operator
 from bpy_extras import view3d_utils
 from mathutils import Vector
+from bpy.props import EnumProperty, FloatProperty, IntProperty, BoolProperty
 from gpu_extras.presets import draw_circle_2d
 from gpu_extras.batch import batch_for_shader
 from math import copysign
 import gpu
+import os
+import tempfile
+import numpy as np
+
+from . import stroke_io
+from . import raster
+from .gp_CreateMaterials import assign_material
 
 startend_points = []
 
@@ -85,6 +93,7 @@ def draw_callback_px(self, context): # callback to draw polygon real time
 class PaintInsideColorOperator(bpy.types.Operator):
     """Draw polygon with on screen color.
 Left click to draw polygon. SPACE/ENTER/MIDDLEMOUSE to add as new stroke.
+In Region mode a left click outlines the whole region of the clicked color.
 Right click/ESC to finish.
 
 Brush color is used as the FILL color, secondary_color is used as the STROKE color.
@@ -94,6 +103,13 @@ Brush color is used as the FILL color, secondary_color is used as the STROKE col
     bl_label = "PaintInsideColor"
     bl_options = {'REGISTER', 'UNDO' }
     
+    mode : EnumProperty(name = "Mode", description = "How the outline is found",
+        items = (('TRACE', "Trace", "Follow the mouse along the edge of the color"),
+            ('REGION', "Region", "Outline the whole region of the clicked color in one click")),
+        default = 'TRACE')
+    simplify : FloatProperty(name = "Simplify", description = "Maximum distance in pixels the simplified region outline may deviate",
+        default = 1.0, min = 0.0, max = 50.0)
+    
     maskColor = None
     mousePath = []
     tracePath = []
@@ -122,14 +138,11 @@ Brush color is used as the FILL color, secondary_color is used as the STROKE col
         
         for frame in layer.frames:
             if frame.frame_number == C.scene.frame_current:
-                newStroke = frame.strokes.new()
+                co = [to3d(context, pt) for pt in self.mousePath]
+                newStroke = stroke_io.new_stroke(frame, co, vertex_color = vertexColor)
                 newStroke.line_width = lineWidth
                 newStroke.material_index = matIndex
                 newStroke.vertex_color_fill = fillColor                        
-                newStroke.points.add( len(self.mousePath) )
-                for idx, pt in enumerate(self.mousePath):
-                    newStroke.points[idx].co = to3d(context, pt)
-                    newStroke.points[idx].vertex_color = vertexColor
                 newStroke.use_cyclic = self.close
                 newStroke.uv_scale = 1
 
@@ -141,49 +154,47 @@ Brush color is used as the FILL color, secondary_color is used as the STROKE col
 
     
     def getImgPixel(self, X, Y):
-        context = bpy.context
-        offset = int(self.width * (Y + context.area.y) * 4 + (X + context.area.x) * 4)
-        
-        if offset + 3 >= len(self.pixelBuffer) or offset < 0:
-            print("ERROR: " + str(X) + ", " + str(Y) + " out of bounds")
-            return 0, 0, 0
-        
-        R, G, B = self.pixelBuffer[offset:offset + 3]
-        
-        return R, G, B
+        return self.sampler.color(X, Y)
     
     def onEdge(self, dx, dy, maskColor):
-        for y in range(3):
-            for x in range(3):
-                clr = self.getImgPixel(dx + x - 1, dy + y - 1)
-                if not cmp(clr, maskColor):
-                    return True
-        return False
+        return bool(self.sampler.on_edge( [dx], [dy], maskColor)[0])
         
     
     def modal(self, context, event):
         context.area.tag_redraw()
         
-        if self.state == 0: # TAKE BLENDER INTERFACE SCREENSHOT
+        if self.state == 0: # CAPTURE SCREEN
             
             self.viewport_info = gpu.state.viewport_get()
             self.width = self.viewport_info[2]
             self.height = self.viewport_info[3]
-            self.framebuffer = gpu.state.active_framebuffer_get()
-
-            self.pixelBuffer = self.framebuffer.read_color(0, 0, self.width, self.height, 4, 0, 'FLOAT')
-            self.pixelBuffer.dimensions = self.width * self.height * 4
-
-            self.framebuffer_image = bpy.data.images.new("color_buffer_copy" , 32, 32, float_buffer=True)
-            self.framebuffer_image.scale(self.width, self.height)
-            self.framebuffer_image.pixels.foreach_set(self.pixelBuffer)
-            self.framebuffer_image.save(filepath="c:\\tmp\\x.png")
+            
+            # the screen is read once before anything is traced over it, as
+            # bytes, precise enough for the color tolerance. Region coordinates
+            # are offset by the area position
+            framebuffer = gpu.state.active_framebuffer_get()
+            buffer = framebuffer.read_color(0, 0, self.width, self.height, 4, 0, 'UBYTE')
+            buffer.dimensions = self.width * self.height * 4
+            self.pixels = raster.as_pixels(buffer, self.width, self.height, dtype = np.uint8)
+            self.sampler = raster.PixelSampler(self.pixels, (context.area.x, context.area.y))
             
             self.state = 1
             
         else: # PROCESS NORMALLY
             
-            if event.type == 'LEFTMOUSE':
+            if event.type == 'LEFTMOUSE' and event.value == 'PRESS' and self.mode == 'REGION':
+                bounds = (0, 0, min(context.area.width, self.width - context.area.x),
+                    min(context.area.height, self.height - context.area.y))
+                outline = raster.sampled_region_outline(self.sampler, (event.mouse_region_x, event.mouse_region_y),
+                    bounds, simplify_tolerance = self.simplify)
+                
+                if len(outline) > 2:
+                    self.mousePath = [tuple(p) for p in outline.tolist()]
+                    self.close = True
+                    self.xyz(context)
+                    self.close = False
+                    
+            elif event.type == 'LEFTMOUSE':
                 if event.value == 'PRESS':
                     self.mousePressed = True
                     
@@ -209,21 +220,15 @@ Brush color is used as the FILL color, secondary_color is used as the STROKE col
                         
                         vtmn = vectorToMouse.normalized()
                         
-                        nextPoint = (lastPoint[0] + vtmn.x, lastPoint[1]+ vtmn.y)
-                        nextPointColor = self.getImgPixel(nextPoint[0], nextPoint[1])
-                        if cmp(nextPointColor, self.maskColor) and self.onEdge(nextPoint[0], nextPoint[1], self.maskColor):
-                            self.mousePath.append((nextPoint[0], nextPoint[1]))
-                        else:
-                            nextPoint = (lastPoint[0] + vtmn.x, lastPoint[1])
-                            nextPointColor = self.getImgPixel(nextPoint[0], nextPoint[1])
-                            if cmp(nextPointColor, self.maskColor) and self.onEdge(nextPoint[0], nextPoint[1], self.maskColor):
-                                self.mousePath.append((nextPoint[0], nextPoint[1]))
-                            else:
-                                nextPoint = (lastPoint[0], lastPoint[1] + vtmn.y)
-                                nextPointColor = self.getImgPixel(nextPoint[0], nextPoint[1])
-                                if cmp(nextPointColor, self.maskColor) and self.onEdge(nextPoint[0], nextPoint[1], self.maskColor):
-                                    self.mousePath.append((nextPoint[0], nextPoint[1]))
-
+                        # step towards the mouse, else only along x, else only along y,
+                        # all three candidates tested at once
+                        candidates = [(lastPoint[0] + vtmn.x, lastPoint[1] + vtmn.y),
+                            (lastPoint[0] + vtmn.x, lastPoint[1]),
+                            (lastPoint[0], lastPoint[1] + vtmn.y)]
+                        xs, ys = zip(*candidates)
+                        ok = self.sampler.edge_matches(xs, ys, self.maskColor)
+                        if ok.any():
+                            self.mousePath.append(candidates[int(ok.argmax())])
                         
 #                        for i in range(int(vectorToMouse.length)):
 #                            pt = vectorToMouse.normalized() * i
@@ -255,7 +260,8 @@ Brush color is used as the FILL color, secondary_color is used as the STROKE col
                 context.area.header_text_set(None)
                 bpy.types.SpaceView3D.draw_handler_remove(self._handle, 'WINDOW')
                 context.area.tag_redraw()
-                del(self.pixelBuffer)
+                del(self.sampler)
+                del(self.pixels)
                 return {'FINISHED'}
 
         return {'RUNNING_MODAL'}
@@ -275,6 +281,192 @@ Brush color is used as the FILL color, secondary_color is used as the STROKE col
             self.report({'WARNING'}, "View3D not found, cannot run operator")
             return {'CANCELLED'}            
     
+def capture_view(context, region):
+    # pixels of the 3D view region as it is on screen
+    framebuffer = gpu.state.active_framebuffer_get()
+    buffer = framebuffer.read_color(region.x, region.y, region.width, region.height, 4, 0, 'UBYTE')
+    buffer.dimensions = region.width * region.height * 4
+    return raster.as_pixels(buffer, region.width, region.height, dtype = np.uint8)
+
+def capture_camera(context, width, height):
+    # the scene camera's view at width x height. Drawn offscreen when there is
+    # a 3D view to draw with, rendered by the scene's render engine otherwise
+    # (blender -b, the render engine then provides the software GL/EGL path)
+    scene = context.scene
+    camera = scene.camera
+    
+    if not bpy.app.background and context.area and context.area.type == 'VIEW_3D':
+        region = next(r for r in context.area.regions if r.type == 'WINDOW')
+        offscreen = gpu.types.GPUOffScreen(width, height)
+        view_matrix = camera.matrix_world.inverted()
+        projection_matrix = camera.calc_matrix_camera(context.evaluated_depsgraph_get(), x = width, y = height)
+        offscreen.draw_view3d(scene, context.view_layer, context.space_data, region,
+            view_matrix, projection_matrix, do_color_management = True)
+        with offscreen.bind():
+            buffer = gpu.state.active_framebuffer_get().read_color(0, 0, width, height, 4, 0, 'UBYTE')
+        offscreen.free()
+        buffer.dimensions = width * height * 4
+        return raster.as_pixels(buffer, width, height, dtype = np.uint8)
+    
+    return render_camera(scene, width, height)
+
+def render_camera(scene, width, height):
+    # render the camera to a temporary file and read it back as (height, width, 4)
+    render = scene.render
+    settings = (render.resolution_x, render.resolution_y, render.resolution_percentage,
+        render.filepath, render.image_settings.file_format)
+    # a file of its own, parallel runs don't overwrite each other's capture
+    fd, path = tempfile.mkstemp(suffix = '.png')
+    os.close(fd)
+    
+    try:
+        try:
+            render.resolution_x, render.resolution_y, render.resolution_percentage = width, height, 100
+            render.filepath = path
+            render.image_settings.file_format = 'PNG'
+            bpy.ops.render.render(write_still = True)
+        finally:
+            (render.resolution_x, render.resolution_y, render.resolution_percentage,
+                render.filepath, render.image_settings.file_format) = settings
+        
+        image = bpy.data.images.load(path)
+        try:
+            pixels = np.empty(width * height * 4, dtype=np.float32)
+            image.pixels.foreach_get(pixels)
+        finally:
+            bpy.data.images.remove(image)
+    finally:
+        os.remove(path)
+    return pixels.reshape(height, width, 4)
+
+def camera_pixels_to_world(scene, camera, points, width, height):
+    # pixel coordinates of a camera capture to points on the y = 0 drawing
+    # plane, through the camera's view frame
+    tr, br, bl, tl = [np.array(camera.matrix_world @ v) for v in camera.data.view_frame(scene = scene)]
+    
+    uv = (np.asarray(points, dtype=np.float64).reshape(-1, 2) + 0.5) / (width, height)
+    p = bl + uv[:, :1] * (br - bl) + uv[:, 1:] * (tl - bl)
+    
+    if camera.data.type == 'ORTHO':
+        d = np.broadcast_to(-np.array(camera.matrix_world.col[2][:3]), p.shape) # camera looks down -Z
+    else:
+        d = p - np.array(camera.matrix_world.translation)
+    
+    dy = np.where(d[:, 1] != 0, d[:, 1], 1.0)
+    return p - d * (p[:, 1] / dy)[:, None]
+
+class PaintAllColorsOperator(bpy.types.Operator):
+    """Outline every color region in the view as a fill stroke with a matching material.
+Use in camera view to vectorize the camera frame, or capture the camera offscreen
+at a fixed resolution (also works in background mode)."""
+
+    bl_idname = "quicktools.paintallcolors"
+    bl_label = "Paint All Colors"
+    bl_options = {'REGISTER', 'UNDO' }
+    
+    source : EnumProperty(name = "Source", description = "What is traced",
+        items = (('VIEW', "View", "The 3D view as it is on screen"),
+            ('CAMERA', "Camera", "The scene camera rendered offscreen at a fixed resolution")),
+        default = 'VIEW')
+    resolution : IntProperty(name = "Resolution", description = "Longest side of the camera capture in pixels, 0 for the render resolution",
+        default = 0, min = 0, max = 16384)
+    all_frames : BoolProperty(name = "All Frames", description = "Capture the camera at every keyframe of the active layer",
+        default = False)
+    simplify : FloatProperty(name = "Simplify", description = "Maximum distance in pixels the simplified outlines may deviate",
+        default = 1.0, min = 0.0, max = 50.0)
+    min_area : IntProperty(name = "Minimum Area", description = "Smallest region in pixels that gets a stroke",
+        default = 16, min = 1)
+    create_materials : BoolProperty(name = "Create Materials", description = "Give the strokes materials with their colors",
+        default = True)
+    
+    @classmethod
+    def poll(self, context):
+        return (context.active_object and context.active_object.type == 'GPENCIL')
+
+    def capture_size(self, scene):
+        render = scene.render
+        width = render.resolution_x * render.resolution_percentage // 100
+        height = render.resolution_y * render.resolution_percentage // 100
+        if self.resolution > 0:
+            scale = self.resolution / max(width, height)
+            width, height = round(width * scale), round(height * scale)
+        return max(width, 1), max(height, 1)
+
+    def addStrokes(self, context, frame, regions, to_world):
+        C = context
+        gp = C.active_object
+        
+        matIndex = gp.active_material_index
+        brush = C.tool_settings.gpencil_paint.brush if C.tool_settings.gpencil_paint else None
+        lineWidth = brush.size if brush else 10
+        
+        count = 0
+        for outline, color, area in regions:
+            if len(outline) < 3:
+                continue
+            fillColor = (s2lin(color[0]), s2lin(color[1]), s2lin(color[2]), 1)
+            
+            newStroke = stroke_io.new_stroke(frame, to_world(outline), vertex_color = fillColor)
+            newStroke.line_width = lineWidth
+            newStroke.material_index = matIndex
+            newStroke.vertex_color_fill = fillColor
+            newStroke.use_cyclic = True
+            newStroke.uv_scale = 1
+            
+            if self.create_materials:
+                assign_material(gp, newStroke)
+            count += 1
+        return count
+
+    def execute(self, context):
+        gp = context.active_object
+        layer = gp.data.layers.active
+        if layer is None or layer.active_frame is None:
+            self.report({'WARNING'}, "No active frame")
+            return {'CANCELLED'}
+        
+        if self.source == 'VIEW':
+            if not context.area or context.area.type != 'VIEW_3D':
+                self.report({'WARNING'}, "View3D not found, cannot run operator")
+                return {'CANCELLED'}
+            
+            region = next(r for r in context.area.regions if r.type == 'WINDOW')
+            rv3d = context.space_data.region_3d
+            
+            # capture once, trace all regions in one go, then create the strokes
+            regions = raster.trace_color_regions(capture_view(context, region),
+                simplify_tolerance = self.simplify, min_area = self.min_area)
+            count = self.addStrokes(context, layer.active_frame, regions,
+                lambda outline: [view3d_utils.region_2d_to_location_3d(region, rv3d, pt, (0,0,0)) for pt in outline.tolist()])
+            
+            self.report({'INFO'}, "Traced {} color regions".format(count))
+            return {'FINISHED'}
+        
+        scene = context.scene
+        camera = scene.camera
+        if camera is None:
+            self.report({'WARNING'}, "Scene has no camera")
+            return {'CANCELLED'}
+        
+        width, height = self.capture_size(scene)
+        current = scene.frame_current
+        frames = [f.frame_number for f in layer.frames] if self.all_frames else [current]
+        
+        count = 0
+        for frame_number in frames:
+            if frame_number != scene.frame_current:
+                scene.frame_set(frame_number)
+            regions = raster.trace_color_regions(capture_camera(context, width, height),
+                simplify_tolerance = self.simplify, min_area = self.min_area)
+            count += self.addStrokes(context, layer.active_frame, regions,
+                lambda outline: camera_pixels_to_world(scene, camera, outline, width, height))
+        
+        if scene.frame_current != current:
+            scene.frame_set(current)
+        
+        self.report({'INFO'}, "Traced {} color regions in {} frames".format(count, len(frames)))
+        return {'FINISHED'}
+
 """ class PGP_PT_sidebarPaintInsideColorPanel(bpy.types.Panel):
     bl_label = "PaintInsideColor"
     bl_space_type = "VIEW_3D"
@@ -15,11 +15,25 @@ import mathutils
 import operator
 from bpy_extras import view3d_utils
 from mathutils import Vector
+from bpy.props import BoolProperty
 from gpu_extras.presets import draw_circle_2d
 from gpu_extras.batch import batch_for_shader
 import gpu
+import numpy as np
 
-startend_points = []
+from . import stroke_io
+from . import geometry_kernel
+from .spatial_index import PointGrid, StrokeSnapshots
+
+# point and segment snapshots of the strokes of the visible layers, kept up
+# to date stroke by stroke. snap_source tells which object, frame and layers
+# they were taken from
+snap_strokes = StrokeSnapshots()
+snap_source = None
+
+# at most this many segments near the cursor are tested against each other
+# for intersections
+MAX_INTERSECTION_SEGMENTS = 128
 
 def s2lin(x): # convert srgb to linear
     a = 0.055
@@ -36,25 +50,41 @@ def to3d(context, pos2d): # helper function to convert 2d point to 3d
 def to2d(context, pos3d): # helper function to convert 3d point to 2d
     return view3d_utils.location_3d_to_region_2d(context.region, context.space_data.region_3d, pos3d)
                 
-def init_startendpoints(context): # create array of start and end points of all visible strokes
+def view_key(context): # changes whenever the region to 2d projection changes
+    region = context.region
+    matrix = context.space_data.region_3d.perspective_matrix
+    return (tuple(v for row in matrix for v in row), region.width, region.height)
+                
+def sync_snap_strokes(context): # bring the snapshots in line with the visible strokes
+    global snap_strokes, snap_source
+    
     gp = context.active_object
     
     if gp.type != 'GPENCIL':
         return
     
-    startend_points.clear()
+    frame = context.scene.frame_current
+    source = (gp.data.name, frame, tuple(lr.info for lr in gp.data.layers if not lr.hide))
+    if source != snap_source:
+        snap_strokes = StrokeSnapshots()
+        snap_source = source
     
+    # only strokes that are new get snapshotted, deleted ones are dropped
+    lines = {}
+    keys = []
     for lr in gp.data.layers:
         if lr.hide:
             continue
         for fr in lr.frames:
-            if fr.frame_number == context.scene.frame_current:
-                for s in fr.strokes:
-                    if len(s.points) > 0:
-                        #startend_points.append(s.points[0])
-                        #startend_points.append(s.points[-1])
-                        for p in s.points:
-                            startend_points.append(p)
+            if fr.frame_number == frame:
+                arrays, offsets = stroke_io.read_frame(fr, ['co'])
+                for s, start, end in zip(fr.strokes, offsets[:-1], offsets[1:]):
+                    line = (arrays['co'][start:end], s.use_cyclic)
+                    key = stroke_io.co_key(*line)
+                    lines[key] = line
+                    keys.append(key)
+    
+    snap_strokes.update(keys, lines.get)
 
 def draw_callback_px(self, context): # callback to draw polygon real time
     radius = 10
@@ -68,35 +98,48 @@ def draw_callback_px(self, context): # callback to draw polygon real time
 
     gpu.state.line_width_set(lw)
     
-    pt = []
-    
     if len(self.mouse_path) == 0:
         return
     
-    for p in self.mouse_path:
-        pt.append(to2d(context, p))
-        
+    shader = gpu.shader.from_builtin('UNIFORM_COLOR')
+    
+    # committed path and its vertex markers are cached, only the rubber band
+    # segment to the mouse is a new batch every redraw
+    pt = self.path_2d(context)
+    if self.path_batches is None:
+        pos = pt.astype(np.float32)
+        self.path_batches = (batch_for_shader(shader, 'LINE_STRIP', {"pos": pos}),
+            batch_for_shader(shader, 'POINTS', {"pos": pos}))
+    path, markers = self.path_batches
+    
+    batches = [path]
     if self.mouse_pos:
-        pt.append(self.mouse_pos)
+        batches.append(batch_for_shader(shader, 'LINES', {"pos": [tuple(pt[-1].tolist()), self.mouse_pos]}))
     
-    shader = gpu.shader.from_builtin('UNIFORM_COLOR')
     gpu.state.blend_set('ALPHA')
-    batch = batch_for_shader(shader, 'LINE_STRIP', {"pos": pt})
     
     gpu.state.line_width_set(4.0)
     shader.uniform_float("color", (0.0, 0.0, 0.0, 1.0))
-    batch.draw(shader)
+    for batch in batches:
+        batch.draw(shader)
     
     gpu.state.line_width_set(2.0)
     shader.uniform_float("color", (0.7, 0.7, 0.7, 0.5))
-    batch.draw(shader)
+    for batch in batches:
+        batch.draw(shader)
+    
+    gpu.state.point_size_set(4.0)
+    shader.uniform_float("color", (0.3, 0.3, 0.3, 1))
+    markers.draw(shader)
     
-    for p in self.mouse_path:
-        draw_circle_2d(to2d(context, p), (0.3, 0.3, 0.3, 1), 2)
+    # restore opengl defaults
+    gpu.state.point_size_set(1.0)
+    gpu.state.line_width_set(lw)
+    gpu.state.blend_set('NONE')
 
 
 class snapigonOperator(bpy.types.Operator):
-    """Draw polygon with snapping to nearby points of other strokes.
+    """Draw polygon with snapping to nearby points, segments, midpoints and intersections of other strokes.
 Left click to draw polygon. SPACE/ENTER/MIDDLEMOUSE to add as new stroke.
 SHIFT to disable snapping.
 CTRL to restrict to horizontal/vertical lines.
@@ -109,13 +152,15 @@ Brush color is used as the FILL color, secondary_color is used as the STROKE col
     bl_label = "Snapigon"
     bl_options = {'REGISTER', 'UNDO' }
     
+    snap_segments : BoolProperty(name = "Segments", description = "Snap to the closest point on stroke segments", default = True)
+    snap_midpoints : BoolProperty(name = "Midpoints", description = "Snap to the middle of stroke segments", default = True)
+    snap_intersections : BoolProperty(name = "Intersections", description = "Snap to where strokes cross", default = True)
+    
     @classmethod
     def poll(self, context):
         return (context.active_object and context.active_object.type == 'GPENCIL')
     
     def modal(self, context, event):
-        global startend_points
-        
         if event.type == 'MIDDLEMOUSE' and event.shift:
             self.mouse_pos = None
             return {'PASS_THROUGH'}
@@ -128,7 +173,7 @@ Brush color is used as the FILL color, secondary_color is used as the STROKE col
         self.mouse_pos = (event.mouse_region_x, event.mouse_region_y)
 
         if event.ctrl and len(self.mouse_path) > 0:
-            p2d = to2d(context, self.mouse_path[-1])
+            p2d = tuple(self.path_2d(context)[-1].tolist())
             delta = Vector(p2d) - Vector(self.mouse_pos)
             a = delta.angle((1,0)) * 180 / 3.14159 - 90
             if abs(a) > 45:
@@ -142,7 +187,7 @@ Brush color is used as the FILL color, secondary_color is used as the STROKE col
 #            if event.shift: return {'RUNNING_MODAL'}
         
             if len(self.mouse_path) > 2:
-                p2d = to2d(context, self.mouse_path[0])
+                p2d = tuple(self.path_2d(context)[0].tolist())
                 delta = Vector(p2d) - Vector(self.mouse_pos)
                 if delta.length < self.pixels:
                     self.selectedPoint = context, self.mouse_path[0]
@@ -152,21 +197,24 @@ Brush color is used as the FILL color, secondary_color is used as the STROKE col
             if self.close:
                 context.window.cursor_modal_set("DOT")
             else:
-                for p in startend_points:
-                    p3d = (p.co[0], p.co[1], p.co[2])
-                    p2d = to2d(context, p3d)
-                    delta = Vector(self.mouse_pos) - Vector(p2d)
+                grid, ids = self.snap_index(context)
+                k = grid.nearest(self.mouse_pos[0], self.mouse_pos[1], self.pixels)
+                
+                if k is not None:
+                    p3d = tuple(snap_strokes.points()[ids[k]].tolist())
+                    self.selectedPoint = p3d
+                    self.drawPoint = tuple(grid.points[k].tolist())
+                    context.window.cursor_modal_set("PAINT_CROSS")
+                    
+                    if event.shift: 
+                        if self.mouse_path.count(self.selectedPoint) == 0:
+                            self.add_point(self.selectedPoint)
                     
-                    if delta.length < self.pixels:
-                        self.selectedPoint = p3d
-                        self.drawPoint = p2d
+                elif self.snap_segments or self.snap_midpoints or self.snap_intersections:
+                    snap = self.snap_segment(context)
+                    if snap:
+                        self.selectedPoint, self.drawPoint = snap
                         context.window.cursor_modal_set("PAINT_CROSS")
-                        
-                        if event.shift: 
-                            if self.mouse_path.count(self.selectedPoint) == 0:
-                                self.mouse_path.append(self.selectedPoint)
-                            
-                        break
                     
                 if self.selectedPoint == None:
                     context.window.cursor_modal_set("CROSSHAIR")
@@ -177,10 +225,10 @@ Brush color is used as the FILL color, secondary_color is used as the STROKE col
                 self.xyz(context)
             else:
                 if self.selectedPoint:
-                    self.mouse_path.append(self.selectedPoint)
+                    self.add_point(self.selectedPoint)
                 else:
                     pos = to3d(context, self.mouse_pos)
-                    self.mouse_path.append(pos)
+                    self.add_point(pos)
             
         elif event.type in {'SPACE', 'ENTER', 'MIDDLEMOUSE'} and event.value == 'RELEASE':
             self.xyz(context)        
@@ -194,9 +242,122 @@ Brush color is used as the FILL color, secondary_color is used as the STROKE col
 
         return {'RUNNING_MODAL'}
     
-    def xyz(self, context):
-        global startend_points
+    def snap_index(self, context):
+        # snap candidates projected to region space once, the grid is only
+        # rebuilt when the view or the candidates change
+        region = context.region
+        matrix = context.space_data.region_3d.perspective_matrix
+        view = view_key(context)
+        candidates = snap_strokes.points()
+        
+        if self.snap_grid is None or self.snap_view != view or self.snap_points is not candidates:
+            points, w = geometry_kernel.project_to_region(candidates, matrix, region.width, region.height)
+            ids = (w > 0).nonzero()[0]
+            r = self.pixels
+            self.snap_grid = (PointGrid(points[ids], r, (-r, -r, region.width + r, region.height + r)), ids)
+            self.snap_view = view
+            self.snap_points = candidates
+            
+        return self.snap_grid
+
+    def add_point(self, p):
+        self.mouse_path.append(p)
+        self.path_version += 1
+
+    def path_2d(self, context):
+        # mouse_path projected to region space, only redone when the view or
+        # the path changes
+        key = view_key(context) + (self.path_version,)
+        if self.path_key != key:
+            region = context.region
+            matrix = context.space_data.region_3d.perspective_matrix
+            self.path_points = geometry_kernel.project_to_region(self.mouse_path, matrix, region.width, region.height)[0]
+            self.path_batches = None
+            self.path_key = key
+        return self.path_points
+
+    def snap_segment(self, context):
+        # nearest intersection, midpoint or point on a segment within
+        # self.pixels, in that order. Candidate segments come from the frame's
+        # segment index, only they are projected
+        segment_index = snap_strokes.segments
+        if segment_index is None or len(segment_index) == 0:
+            return None
+        
+        mx, my = self.mouse_pos
+        r = self.pixels
+        corners = [to3d(context, (mx + dx, my + dy)) for dx in (-r, r) for dy in (-r, r)]
+        xs = [c[0] for c in corners]
+        zs = [c[2] for c in corners]
+        
+        found = segment_index.query(min(xs), min(zs), max(xs), max(zs))
+        if not found:
+            return None
+        
+        a3d = []
+        b3d = []
+        for key, segments in found.items():
+            co, cyclic = snap_strokes.line(key)
+            a3d.append(co[segments])
+            b3d.append(co[(segments + 1) % len(co)])
+        a3d = np.concatenate(a3d).astype(np.float64)
+        b3d = np.concatenate(b3d).astype(np.float64)
+        
+        region = context.region
+        matrix = context.space_data.region_3d.perspective_matrix
+        a, wa = geometry_kernel.project_to_region(a3d, matrix, region.width, region.height)
+        b, wb = geometry_kernel.project_to_region(b3d, matrix, region.width, region.height)
+        visible = (wa > 0) & (wb > 0)
+        a3d, b3d, a, b, wa, wb = a3d[visible], b3d[visible], a[visible], b[visible], wa[visible], wb[visible]
+        
+        def nearest(points3d, points2d):
+            if len(points2d) == 0:
+                return None
+            d = np.sqrt( ( (points2d - (mx, my)) ** 2).sum(axis=1))
+            k = np.argmin(d)
+            if d[k] >= r:
+                return None
+            return tuple(points3d[k].tolist()), tuple(points2d[k].tolist())
+        
+        def on_segment(k, t):
+            s = geometry_kernel.perspective_correct(t, wa[k], wb[k])
+            return a3d[k] + (b3d[k] - a3d[k]) * s[:, None]
         
+        if self.snap_intersections and len(a) > 1:
+            # an intersection within r lies on two segments that both pass
+            # within r, only the closest of those are paired up
+            d = geometry_kernel.closest_on_segments( (mx, my), a, b)[2]
+            near = (d < r).nonzero()[0]
+            if len(near) > MAX_INTERSECTION_SEGMENTS:
+                near = near[np.argsort(d[near])[:MAX_INTERSECTION_SEGMENTS]]
+            i, j = np.triu_indices(len(near), 1)
+            i, j = near[i], near[j]
+            
+            # pairs whose screen bounds overlap
+            lo = np.minimum(a, b)
+            hi = np.maximum(a, b)
+            overlap = (lo[i] <= hi[j]).all(axis=1) & (lo[j] <= hi[i]).all(axis=1)
+            i, j = i[overlap], j[overlap]
+            
+            hit, points, u = geometry_kernel.segment_intersections(a[i], b[i], a[j], b[j])
+            snap = nearest(on_segment(i[hit], u[hit]), points[hit])
+            if snap:
+                return snap
+        
+        if self.snap_midpoints:
+            mids = (a3d + b3d) / 2
+            points, w = geometry_kernel.project_to_region(mids, matrix, region.width, region.height)
+            snap = nearest(mids, points)
+            if snap:
+                return snap
+            
+        if self.snap_segments:
+            points, t, d = geometry_kernel.closest_on_segments( (mx, my), a, b)
+            return nearest(on_segment(np.arange(len(a)), t), points)
+        
+        return None
+
+    def xyz(self, context):
         C = context
 
         matIndex = C.active_object.active_material_index
@@ -211,21 +372,23 @@ Brush color is used as the FILL color, secondary_color is used as the STROKE col
         gp = C.active_object
         layer = gp.data.layers[gp.data.layers.active_index]
         
+        co = np.array(self.mouse_path, dtype=np.float32).reshape(-1, 3)
+        
         for frame in layer.frames:
             if frame.frame_number == C.scene.frame_current:
-                newStroke = frame.strokes.new()
+                newStroke = stroke_io.new_stroke(frame, co, vertex_color = vertexColor)
                 newStroke.line_width = lineWidth
                 newStroke.material_index = matIndex
                 newStroke.vertex_color_fill = fillColor                        
-                newStroke.points.add( len(self.mouse_path) )
-                for idx, pt in enumerate(self.mouse_path):
-                    newStroke.points[idx].co = pt
-                    newStroke.points[idx].vertex_color = vertexColor
                 newStroke.use_cyclic = self.close
                 newStroke.uv_scale = 1
+                
+                # only the new stroke goes into the snap index
+                if not layer.hide:
+                    snap_strokes.add(stroke_io.co_key(co, self.close), co, self.close)
 
-        init_startendpoints(context)
         self.mouse_path.clear()
+        self.path_version += 1
         self.selectedPoint = None
         self.drawPoint = None
         self.close = False
@@ -239,8 +402,14 @@ Brush color is used as the FILL color, secondary_color is used as the STROKE col
         self.mouse_path.clear()
         self.pixels = 8
         self.close = False
+        self.snap_grid = None
+        self.snap_view = None
+        self.snap_points = None
+        self.path_version = 0
+        self.path_key = None
+        self.path_batches = None
 
-        init_startendpoints(context)
+        sync_snap_strokes(context)
 
         if context.area.type == 'VIEW_3D':
             self._handle = bpy.types.SpaceView3D.draw_handler_add(draw_callback_px, (self, context), 'WINDOW', 'POST_PIXEL')                    
@@ -14,56 +14,34 @@ import os
 import bpy
 import blf
 import gpu
-import json
+import numpy as np
 from gpu_extras.batch import batch_for_shader
-from bpy_extras import view3d_utils
+from mathutils import Matrix
 
-inputData = None
+from . import stroke_io
+from . import glyph_cache
 
-def draw_callback_px(self, context):
-    
-    redraw = False
-
-    if context.scene.gptext_xpos != self._xoff:
-        self._xoff = context.scene.gptext_xpos
-        redraw = True
-    
-    if context.scene.gptext_ypos != self._yoff:
-        self._yoff = context.scene.gptext_ypos
-        redraw = True
-
-    if context.scene.gptext_cx != self._cx:
-        self._cx = context.scene.gptext_cx
-        redraw = True
-    
-    if context.scene.gptext_cy != self._cy:
-        self._cy = context.scene.gptext_cy
-        redraw = True
-
-    if context.scene.gptext_size != self._size:
-        self._size = context.scene.gptext_size
-        redraw = True
+charData = {} # character : compiled glyph_cache.Glyph
 
-    if context.scene.align != self._align:
-        self._align = context.scene.align
-        redraw = True
-
-    if context.scene.gptext != self._text:
-        self._text = context.scene.gptext
-        redraw = True
+def draw_callback_view(self, context):
+    scene = context.scene
+    shader = gpu.shader.from_builtin('UNIFORM_COLOR')
 
-    if redraw == True:
-        self._strokes = self.buildString(context)
-        redraw = False
-        
-    area = context.area
-    space = area.spaces[0]
-    
-    for region in area.regions:
-        if region.type == 'WINDOW':
-            break
+    # the batch holds the text in text space and is only rebuilt when the
+    # layout changes, position and size are applied as the model matrix
+    key = (scene.gptext, scene.gptext_cx, scene.gptext_cy, scene.align)
+    if key != self._batchKey:
+        points, offsets = self.layoutText(context)
+        pos = np.zeros( (len(points), 3), dtype=np.float32)
+        pos[:, 0] = points[:, 0]
+        pos[:, 2] = points[:, 1]
+        lines = glyph_cache.stroke_lines(offsets).astype(np.int32)
+        self._batch = batch_for_shader(shader, 'LINES', {"pos": pos}, indices = lines) if len(lines) else None
+        self._batchKey = key
+
+    if self._batch is None:
+        return
 
-    shader = gpu.shader.from_builtin('UNIFORM_COLOR')
     gpu.state.blend_set('ALPHA')
 
     lineWidth = int(context.scene.gptext_thickness / 7)
@@ -73,13 +51,11 @@ def draw_callback_px(self, context):
     clr = (s2lin(clr.r), s2lin(clr.g), s2lin(clr.b), 1)
     shader.uniform_float("color", clr)
 
-    for stroke in self._strokes:
-        stroke2d = []
-        for point in stroke:
-            p = view3d_utils.location_3d_to_region_2d(region, space.region_3d, (point[0],0,point[1]))
-            stroke2d.append(p)
-        batch = batch_for_shader(shader, 'LINE_STRIP', {"pos": stroke2d})
-        batch.draw(shader)    
+    scale = scene.gptext_size * 0.1
+    gpu.matrix.push()
+    gpu.matrix.multiply_matrix(Matrix.Translation( (scene.gptext_xpos, 0, scene.gptext_ypos) ) @ Matrix.Diagonal( (scale, scale, scale, 1) ))
+    self._batch.draw(shader)
+    gpu.matrix.pop()
         
     # restore opengl defaults
     gpu.state.line_width_set(1.0)
@@ -103,101 +79,25 @@ class GPTEXT_OT_DrawTextOperator(bpy.types.Operator):
     _handle = None
     _last_text_drawn = ""
     
-    _cx = 0
-    _cy = 0
-    _xoff = 0
-    _yoff = 0
-    _size = 0
-    _align = 0
-    _text = ""
-
-    def getMinMax(self, ch):
-        ch_min = 999
-        ch_max = -999       
-        
-        data = charData.get(ch)
-
-        if data == None:
-            return ch_min, ch_max
-
-        for ss in data:
-            if len(ss) < 2:
-                continue
-            if isinstance(ss[0], float):
-                ch_min = min(ch_min, ss[0])
-                ch_max = max(ch_max, ss[0])
-            else:
-                for pp in ss:
-                    ch_min = min(ch_min, pp[0])
-                    ch_max = max(ch_max, pp[0])
-                
-        return ch_min, ch_max
-
-    def getStringWidth(self, string, spacing, defaultWidth):
-        width = 0
-        for ch in string:
-            ch_min, ch_max = self.getMinMax(ch)
-            if ch_max != -999:
-                if width > 0: width += spacing
-                width += abs(ch_max - ch_min)
-            else:
-                width += defaultWidth - spacing
-                
-        return width
+    _layout = None
+    _batch = None
+    _batchKey = None
+
+    def layoutText(self, context):
+        # strokes of the text in text space, as points and stroke offsets
+        scene = context.scene
+        if self._layout is None or self._layout.glyphs is not charData:
+            self._layout = glyph_cache.TextLayout(charData)
+        return self._layout.layout(scene.gptext, scene.gptext_cx, scene.gptext_cy, int(scene.align))
     
-    def buildString(self, context):
-        
-        stringStrokes = []
+    def buildText(self, context):
+        # strokes of the text in the drawing plane, as points and stroke offsets
+        points, offsets = self.layoutText(context)
         
-        xoff = context.scene.gptext_xpos
-        yoff = context.scene.gptext_ypos
         scale = context.scene.gptext_size * 0.1
-        spacing = context.scene.gptext_cx
-        defaultWidth = 1.7
-        
-        lines = context.scene.gptext.split("\\n")
-
-        for string in lines:
-            xoff = context.scene.gptext_xpos
-            stringWidth = self.getStringWidth(string, spacing, defaultWidth)
-
-            if context.scene.align == '1':
-                xoff -= stringWidth / 2 * scale
-            elif context.scene.align == '2':
-                xoff -= stringWidth * scale
-            
-            offset = 0
-            
-            for idx,ch in enumerate(string):
-                ch_min, ch_max = self.getMinMax(ch)
-                if ch_max != -999:
-                    if idx > 0: offset += spacing
-                    strokePoints = []
-                    data = charData.get(ch)
-                    for stroke in data:
-                        if len(stroke) < 2: continue
-                        if isinstance(stroke[0], float):
-                            px = xoff + (stroke[0] + offset - ch_min) * scale
-                            py = yoff + stroke[1] * scale
-                            strokePoints.append( (px, py) )
-                        else:
-                            for point in stroke:
-                                if len(point) == 2:
-                                    px = xoff + (point[0] + offset - ch_min) * scale
-                                    py = yoff + point[1] * scale
-                                    strokePoints.append( (px, py) )
-                                    
-                            stringStrokes.append(strokePoints)
-                            strokePoints = []            
-                    if len(strokePoints) > 1:
-                        stringStrokes.append(strokePoints)
-                    offset += abs(ch_max - ch_min)
-                else:
-                    offset += defaultWidth - spacing
-                    
-            yoff -= context.scene.gptext_cy * scale
+        points = points * scale + (context.scene.gptext_xpos, context.scene.gptext_ypos)
                     
-        return stringStrokes
+        return points, offsets
     
     def invoke(self, context, event):
         global charData
@@ -208,15 +108,15 @@ class GPTEXT_OT_DrawTextOperator(bpy.types.Operator):
             print("Missing: " + jsonFile)
             return {'CANCELLED'}
         
-        inputData = open(jsonFile, "rt")
-        
-        charData = json.load(inputData)
-        self._strokes = self.buildString(context)
+        # compiled once, shared until the json changes
+        charData = glyph_cache.load_font(jsonFile)
+        self._layout = glyph_cache.TextLayout(charData)
+        self._batchKey = None
         context.area.tag_redraw()
         x = context.area.x + int(context.area.width / 2)
         y = context.area.y
         context.window.cursor_warp(x,y + 120);
-        self._handle = bpy.types.SpaceView3D.draw_handler_add(draw_callback_px, (self, context), 'WINDOW', 'POST_PIXEL')
+        self._handle = bpy.types.SpaceView3D.draw_handler_add(draw_callback_view, (self, context), 'WINDOW', 'POST_VIEW')
         return context.window_manager.invoke_props_dialog(self)
 
     def draw(self, context):
@@ -247,7 +147,8 @@ class GPTEXT_OT_DrawTextOperator(bpy.types.Operator):
             self._handle = None
             
         matIndex = 0
-        vertexColor = context.tool_settings.gpencil_paint.brush.color
+        clr = context.tool_settings.gpencil_paint.brush.color
+        vertexColor = (s2lin(clr.r), s2lin(clr.g), s2lin(clr.b), 1)
         fillColor = (1,0,0,1)
         lineWidth = int(context.scene.gptext_thickness)
         
@@ -263,16 +164,13 @@ class GPTEXT_OT_DrawTextOperator(bpy.types.Operator):
             self.report({'ERROR'}, "No keyframe added at current frame")
             return {'FINISHED'}        
             
-        for stroke in self._strokes:
-            newStroke = frame.strokes.new()
+        # all points converted at once, each stroke is one allocation and one
+        # foreach_set per attribute
+        points, offsets = self.buildText(context)
+        for newStroke in stroke_io.new_strokes(frame, stroke_io.xz_to_co(points), offsets, vertex_color = vertexColor):
             newStroke.line_width = lineWidth
             newStroke.material_index = matIndex
             newStroke.vertex_color_fill = fillColor
-            for point in stroke:
-                newStroke.points.add( 1 )
-                newStroke.points[-1].co = ( point[0], 0, point[1] )
-                newStroke.points[-1].vertex_color = (s2lin(vertexColor.r),
-                    s2lin(vertexColor.g), s2lin(vertexColor.b), 1)
                     
         #self.report({'INFO'}, "Done")
         return {'FINISHED'}        
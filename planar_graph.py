@@ -0,0 +1,329 @@
+import math
+
+from . import geometry_kernel
+from .spatial_index import UniformGrid, cell_size_for
+
+# Planar arrangement of grease pencil stroke edges (2D, x/z plane).
+# Edges are bucketed in a uniform grid so each edge is only intersection tested
+# against the edges whose bounding boxes overlap its own, instead of every edge.
+
+PREC = 4
+
+def segment_intersection(a0, a1, b0, b1):
+    # same contract as mathutils.geometry.intersect_line_line_2d, point or None
+    s10x, s10y = a1[0] - a0[0], a1[1] - a0[1]
+    s32x, s32y = b1[0] - b0[0], b1[1] - b0[1]
+    s20x, s20y = b0[0] - a0[0], b0[1] - a0[1]
+
+    d = s10x * s32y - s10y * s32x
+
+    if d != 0:
+        u = (s20x * s32y - s20y * s32x) / d
+        v = (s20x * s10y - s20y * s10x) / d
+        if 0 <= u <= 1 and 0 <= v <= 1:
+            return (a0[0] + s10x * u, a0[1] + s10y * u)
+        return None
+
+    if s10x * s20y - s10y * s20x != 0:
+        return None # parallel
+
+    # collinear, only a single shared end point counts as an intersection
+    for p in (a0, a1):
+        if p == b0 or p == b1:
+            if (min(a0[0], a1[0]) < max(b0[0], b1[0]) and max(a0[0], a1[0]) > min(b0[0], b1[0])) or \
+                (min(a0[1], a1[1]) < max(b0[1], b1[1]) and max(a0[1], a1[1]) > min(b0[1], b1[1])):
+                return None # overlapping
+            return p
+    return None
+
+def pair_crossings(edges_a, edges_b, prec = PREC):
+    # intersections of edges_a[k] with edges_b[k] for all candidate pairs in one
+    # vectorized pass, as (k, rounded point) for the pairs that intersect
+    if not edges_a:
+        return []
+
+    a = geometry_kernel.as_segments(edges_a)
+    b = geometry_kernel.as_segments(edges_b)
+    mask, points, u = geometry_kernel.segment_intersections(a[:, 0], a[:, 1], b[:, 0], b[:, 1])
+
+    result = list(zip(mask.nonzero()[0].tolist(), points[mask].tolist()))
+
+    # parallel pairs can still touch at a shared end point
+    parallel = geometry_kernel.segments_parallel(a[:, 0], a[:, 1], b[:, 0], b[:, 1])
+    for k in parallel.nonzero()[0].tolist():
+        ix = segment_intersection(edges_a[k][0], edges_a[k][1], edges_b[k][0], edges_b[k][1])
+        if ix:
+            result.append( (k, ix) )
+
+    return [(k, (round(p[0], prec), round(p[1], prec))) for k, p in result]
+
+def edge_bounds(edge):
+    (x1, y1), (x2, y2) = edge
+    return (min(x1, x2), min(y1, y2), max(x1, x2), max(y1, y2))
+
+def build_edge_grid(edges):
+    bounds = [edge_bounds(e) for e in edges]
+    grid = UniformGrid(cell_size_for(bounds))
+    for idx, b in enumerate(bounds):
+        grid.insert(idx, *b)
+    return grid, bounds
+
+def edge_intersections(edges, prec = PREC):
+    # per edge list of (distance from edge start, rounded intersection point)
+    grid, bounds = build_edge_grid(edges)
+
+    intersections = [[] for e in edges]
+
+    # each pair is tested once
+    pairs = [(idx, other) for idx, edge in enumerate(edges)
+        for other in grid.query(*bounds[idx]) if other > idx and edges[other] != edge]
+
+    for k, ix in pair_crossings([edges[j] for i, j in pairs], [edges[i] for i, j in pairs], prec):
+        idx, other = pairs[k]
+        intersections[idx].append((math.dist(edges[idx][0], ix), ix))
+        intersections[other].append((math.dist(edges[other][0], ix), ix))
+
+    for ixs in intersections:
+        ixs.sort()
+
+    return intersections
+
+def add_split_edges(edge, intersections, polyedges):
+    # add the pieces of edge between its sorted intersections to polyedges
+    if len(intersections) == 0: # no shared point?
+        return
+    elif len(intersections) == 1:
+        if (edge[1], edge[0]) not in polyedges:
+            polyedges[edge] = None
+    else:
+        pt = edge[0]
+        for ix in intersections:
+            if ix[1] == pt or ix[1] == (pt[1], pt[0]):
+                continue
+            newedge = (pt, ix[1])
+            if (newedge[1], newedge[0]) not in polyedges:
+                polyedges[newedge] = None
+            pt = ix[1]
+
+def split_edges(rawedges, prec = PREC):
+    # split raw edges at their intersections and return the unique sub edges
+    polyedges = {}
+
+    for edge, intersections in zip(rawedges, edge_intersections(rawedges, prec)):
+        add_split_edges(edge, intersections, polyedges)
+
+    return list(polyedges)
+
+def signed_area(poly):
+    area = 0
+    for (x1, y1), (x2, y2) in zip(poly, poly[1:] + poly[:1]):
+        area += x1 * y2 - x2 * y1
+    return area / 2
+
+
+class Face:
+    def __init__(self, index, halfedges, polygon):
+        self.index = index
+        self.halfedges = halfedges
+        self.polygon = polygon
+        self.area = signed_area(polygon)
+        xs = [p[0] for p in polygon]
+        ys = [p[1] for p in polygon]
+        self.bounds = (min(xs), min(ys), max(xs), max(ys))
+
+    @property
+    def bounded(self):
+        # faces are traced counter clockwise, the unbounded side of each
+        # connected component comes out clockwise
+        return self.area > 0
+
+
+class HalfEdgeGraph:
+    # Half edge (DCEL) structure over split edges. Half edge h runs from
+    # origin[h] to origin[h ^ 1], outgoing half edges of every vertex are kept
+    # sorted counter clockwise so next[h] is a single lookup, and all faces
+    # are traced once when the graph is built.
+
+    def __init__(self, edges):
+        self.vertices = []
+        self.origin = []
+
+        index = {}
+        for a, b in edges:
+            if a == b:
+                continue
+            for p in (a, b):
+                if p not in index:
+                    index[p] = len(self.vertices)
+                    self.vertices.append(p)
+            self.origin.append(index[a])
+            self.origin.append(index[b])
+
+        self.outgoing = [[] for v in self.vertices]
+        for h, v in enumerate(self.origin):
+            self.outgoing[v].append(h)
+
+        position = [0] * len(self.origin)
+        for v, hs in enumerate(self.outgoing):
+            vx, vy = self.vertices[v]
+            hs.sort(key = lambda h: math.atan2(self.vertices[self.origin[h ^ 1]][1] - vy,
+                self.vertices[self.origin[h ^ 1]][0] - vx))
+            for i, h in enumerate(hs):
+                position[h] = i
+
+        # next edge around a face is the outgoing edge clockwise from the twin
+        self.next = [0] * len(self.origin)
+        for h in range(len(self.origin)):
+            twin = h ^ 1
+            hs = self.outgoing[self.origin[twin]]
+            self.next[h] = hs[position[twin] - 1]
+
+        self.faces = []
+        self.face_of = [-1] * len(self.origin)
+        for start in range(len(self.origin)):
+            if self.face_of[start] != -1:
+                continue
+            halfedges = []
+            h = start
+            while self.face_of[h] == -1:
+                self.face_of[h] = len(self.faces)
+                halfedges.append(h)
+                h = self.next[h]
+            polygon = [self.vertices[self.origin[h]] for h in halfedges]
+            self.faces.append(Face(len(self.faces), halfedges, polygon))
+
+        bounded = [f for f in self.faces if f.bounded]
+        self.face_grid = UniformGrid(cell_size_for([f.bounds for f in bounded]))
+        for f in bounded:
+            self.face_grid.insert(f.index, *f.bounds)
+
+    def bounded_faces(self):
+        return [f for f in self.faces if f.bounded]
+
+    def locate(self, pt):
+        # smallest bounded face containing pt, holes are not subtracted
+        x, y = pt
+        candidates = sorted((self.faces[i] for i in self.face_grid.query(x, y, x, y)), key = lambda f: f.area)
+        if not candidates:
+            return None
+        inside = geometry_kernel.points_in_polygons( [pt], [f.polygon for f in candidates])[0]
+        for face, hit in zip(candidates, inside):
+            if hit:
+                return face
+        return None
+
+
+class Arrangement:
+    # Edges of a set of strokes split at their intersections, kept up to date
+    # stroke by stroke. Strokes are keyed by a hash of their content so only
+    # strokes that were added, removed or edited get (re)inserted, and only
+    # the intersections of their edges are recomputed.
+
+    def __init__(self, prec = PREC):
+        self.prec = prec
+        self.grid = None
+        self.edges = {}      # edge id : edge
+        self.edge_ids = {}   # undirected edge : [edge id, reference count]
+        self.crossings = {}  # edge id : {other edge id : (distance from edge start, point)}
+        self.strokes = {}    # stroke key : [reference count, undirected edges]
+        self.next_id = 0
+        self.graph = None
+
+    def update(self, keys, stroke_edges):
+        # keys: content keys of all strokes now in the frame (duplicates allowed)
+        # stroke_edges(key): raw edges of a stroke, only called for new strokes
+        counts = {}
+        for key in keys:
+            counts[key] = counts.get(key, 0) + 1
+
+        # the face graph only has to be rebuilt when edges come or go, not
+        # for strokes whose edges are all shared with other strokes
+        changed = False
+
+        removed = [key for key in self.strokes if key not in counts]
+        for key in removed:
+            for uedge in self.strokes.pop(key)[1]:
+                changed |= self.release_edge(uedge)
+
+        added = {key : stroke_edges(key) for key in counts if key not in self.strokes}
+
+        if self.grid is None:
+            bounds = [edge_bounds(e) for edges in added.values() for e in edges]
+            self.grid = UniformGrid(cell_size_for(bounds))
+
+        new_ids = []
+        for key, edges in added.items():
+            uedges = []
+            for edge in edges:
+                if edge[0] == edge[1]:
+                    continue
+                uedge = edge if edge[0] <= edge[1] else (edge[1], edge[0])
+                uedges.append(uedge)
+                eid = self.acquire_edge(uedge, edge)
+                if eid is not None:
+                    new_ids.append(eid)
+            self.strokes[key] = [0, uedges]
+
+        self.add_crossings(new_ids)
+
+        for key, count in counts.items():
+            self.strokes[key][0] = count
+
+        if changed or new_ids:
+            self.graph = None
+
+        return len(added), len(removed)
+
+    def acquire_edge(self, uedge, edge):
+        # returns the id of the edge if it is new to the arrangement
+        entry = self.edge_ids.get(uedge)
+        if entry:
+            entry[1] += 1
+            return None
+
+        eid = self.next_id
+        self.next_id += 1
+        self.edge_ids[uedge] = [eid, 1]
+        self.edges[eid] = edge
+        self.crossings[eid] = {}
+        self.grid.insert(eid, *edge_bounds(edge))
+        return eid
+
+    def add_crossings(self, new_ids):
+        # intersect new edges with everything near them, pairs of two new edges once
+        new = set(new_ids)
+        pairs = [(eid, other) for eid in new_ids
+            for other in self.grid.query(*self.grid.bounds[eid])
+                if other != eid and (other not in new or other > eid)]
+
+        edges = self.edges
+        for k, ix in pair_crossings([edges[j] for i, j in pairs], [edges[i] for i, j in pairs], self.prec):
+            eid, other = pairs[k]
+            self.crossings[eid][other] = (math.dist(edges[eid][0], ix), ix)
+            self.crossings[other][eid] = (math.dist(edges[other][0], ix), ix)
+
+    def release_edge(self, uedge):
+        # returns True if the edge is gone from the arrangement
+        entry = self.edge_ids[uedge]
+        entry[1] -= 1
+        if entry[1] > 0:
+            return False
+
+        eid = entry[0]
+        del self.edge_ids[uedge]
+        del self.edges[eid]
+        self.grid.remove(eid)
+        for other in self.crossings.pop(eid):
+            del self.crossings[other][eid]
+        return True
+
+    def polyedges(self):
+        polyedges = {}
+        for eid, edge in self.edges.items():
+            add_split_edges(edge, sorted(self.crossings[eid].values()), polyedges)
+        return list(polyedges)
+
+    def face_graph(self):
+        if self.graph is None:
+            self.graph = HalfEdgeGraph(self.polyedges())
+        return self.graph
@@ -0,0 +1,119 @@
+import numpy as np
+
+# Alignment of point selections as array operations. Points are (n, 3) co
+# arrays, the tools work in the x/z drawing plane: axis 0 is horizontal and
+# axis 2 vertical. No Blender imports.
+
+HORIZONTAL = (0,)
+VERTICAL = (2,)
+BOTH = (0, 2)
+
+def others(count, exclude):
+    mask = np.ones(count, dtype=bool)
+    if exclude is not None:
+        mask[exclude] = False
+    return mask
+
+def align(co, target, axes = BOTH, relative = False, exclude = None):
+    # move the axes of every point (but exclude) to the target's. Relative
+    # keeps the offsets between the points and moves them all by the
+    # smallest move that puts one of them on the target
+    co = np.array(co, dtype=np.float64).reshape(-1, 3)
+    target = np.asarray(target, dtype=np.float64)
+    axes = list(axes)
+    moved = others(len(co), exclude)
+    if not moved.any():
+        return co
+
+    if relative:
+        delta = target[axes] - co[moved][:, axes]
+        offset = delta[np.argmin( (delta ** 2).sum(axis=1))]
+    for k, axis in enumerate(axes):
+        if relative:
+            co[moved, axis] += offset[k]
+        else:
+            co[moved, axis] = target[axis]
+    return co
+
+def distribute(co, axis, groups = None):
+    # space the points evenly along axis between the first and the last,
+    # keeping their order. Groups (e.g. frames) are distributed separately
+    co = np.array(co, dtype=np.float64).reshape(-1, 3)
+    if len(co) < 3:
+        return co
+    groups = np.zeros(len(co), dtype=np.int64) if groups is None else np.asarray(groups)
+
+    # one sort by group then position, rank of every point within its group
+    order = np.lexsort( (co[:, axis], groups) )
+    g = groups[order]
+    starts = np.flatnonzero(np.r_[True, g[1:] != g[:-1]])
+    counts = np.diff(np.r_[starts, len(g)])
+    first = np.repeat(starts, counts)
+    last = np.repeat(starts + counts - 1, counts)
+    rank = np.arange(len(g)) - first
+
+    values = co[order, axis]
+    span = np.maximum(last - first, 1)
+    co[order, axis] = values[first] + (values[last] - values[first]) * rank / span
+    return co
+
+def align_to_line(co, a, b, exclude = None):
+    # move the points onto the line through a and b, perpendicular to it
+    co = np.array(co, dtype=np.float64).reshape(-1, 3)
+    a = np.asarray(a, dtype=np.float64)[[0, 2]]
+    d = np.asarray(b, dtype=np.float64)[[0, 2]] - a
+    ll = d @ d
+    if ll == 0:
+        return co
+
+    moved = others(len(co), exclude)
+    t = ( (co[moved, 0] - a[0]) * d[0] + (co[moved, 2] - a[1]) * d[1]) / ll
+    co[moved, 0] = a[0] + t * d[0]
+    co[moved, 2] = a[1] + t * d[1]
+    return co
+
+def snap_to_grid(co, size, axes = BOTH, origin = (0, 0, 0)):
+    # round the axes of every point to the nearest grid line
+    co = np.array(co, dtype=np.float64).reshape(-1, 3)
+    if size <= 0:
+        return co
+    for axis in axes:
+        co[:, axis] = np.round( (co[:, axis] - origin[axis]) / size) * size + origin[axis]
+    return co
+
+
+if __name__ == "__main__":
+    # benchmark: relative horizontal align of 50k points, the per point
+    # offset search and writes vs the array version
+    import time
+
+    rng = np.random.default_rng(0)
+    n = 50000
+    co = rng.uniform(-10, 10, (n, 3))
+    co[:, 1] = 0
+    target = co[0].copy()
+
+    points = co.tolist()
+    t = time.perf_counter()
+    best = None
+    for p in points[1:]:
+        v = target[0] - p[0]
+        if best is None or abs(v) < abs(best):
+            best = v
+    for p in points[1:]:
+        p[0] = p[0] + best
+    t_loop = time.perf_counter() - t
+
+    t = time.perf_counter()
+    result = align(co, target, HORIZONTAL, relative = True, exclude = 0)
+    t_array = time.perf_counter() - t
+
+    assert np.allclose(result, points)
+    print("relative align of %d points: %.1f ms per point, %.2f ms numpy" % (n, t_loop * 1000, t_array * 1000))
+
+    for name, op in (("distribute", lambda: distribute(co, 0, rng.integers(0, 10, n))),
+                     ("align to line", lambda: align_to_line(co, (0, 0, 0), (1, 0, 1))),
+                     ("snap to grid", lambda: snap_to_grid(co, 0.5))):
+        t = time.perf_counter()
+        op()
+        print("%s of %d points: %.2f ms" % (name, n, (time.perf_counter() - t) * 1000))
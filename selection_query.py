@@ -0,0 +1,122 @@
+import bpy
+import numpy as np
+from bpy.app.handlers import persistent
+
+from . import stroke_io
+
+# Selected points of the editable strokes of a grease pencil object, shared
+# by the point tools. Editable means on an unlocked, visible layer and on the
+# active frame, or on the active and selected frames in multiframe editing.
+#
+# The selection is kept as index arrays (layer, frame, stroke, point) and the
+# select mask of every selected stroke, read with one foreach_get per stroke.
+# No RNA references are kept. Queries are cached until the object's data is
+# updated, so repeated invokes don't walk the strokes again.
+
+selection_cache = {} # (object name, data name, frame, multiedit) : Selection
+
+class Selection:
+    def __init__(self, gp):
+        stroke_layers = []
+        stroke_frames = []
+        stroke_ids = []
+        frame_numbers = []
+        self.masks = []      # select mask of each selected stroke's points
+
+        for li, lr in enumerate(gp.layers):
+            if lr.lock or lr.hide or lr.active_frame is None:
+                continue
+            active = lr.active_frame.frame_number
+            for fi, fr in enumerate(lr.frames):
+                if not (fr.frame_number == active or (gp.use_multiedit and fr.select)):
+                    continue
+                for si, s in enumerate(fr.strokes):
+                    if not s.select:
+                        continue
+                    mask = stroke_io.read_points(s.points, ('select',))['select']
+                    stroke_layers.append(li)
+                    stroke_frames.append(fi)
+                    stroke_ids.append(si)
+                    frame_numbers.append(fr.frame_number)
+                    self.masks.append(mask)
+
+        # per selected stroke
+        self.stroke_layers = np.array(stroke_layers, dtype=np.int64)
+        self.stroke_frames = np.array(stroke_frames, dtype=np.int64)
+        self.stroke_ids = np.array(stroke_ids, dtype=np.int64)
+        self.frame_numbers = np.array(frame_numbers, dtype=np.int64)
+
+        # selected points of stroke k are offsets[k]:offsets[k + 1]
+        counts = np.array([np.count_nonzero(m) for m in self.masks], dtype=np.int64)
+        self.offsets = np.zeros(len(counts) + 1, dtype=np.int64)
+        np.cumsum(counts, out=self.offsets[1:])
+
+        # per selected point
+        self.layers = np.repeat(self.stroke_layers, counts)
+        self.frames = np.repeat(self.stroke_frames, counts)
+        self.strokes = np.repeat(self.stroke_ids, counts)
+        self.points = np.concatenate( [m.nonzero()[0] for m in self.masks] ) if self.masks else np.empty(0, dtype=np.int64)
+
+    def __len__(self):
+        return int(self.offsets[-1])
+
+    def point_frame_numbers(self):
+        return np.repeat(self.frame_numbers, np.diff(self.offsets))
+
+    def stroke_objects(self, gp):
+        # the selected strokes, looked up when needed
+        return [gp.layers[li].frames[fi].strokes[si]
+            for li, fi, si in zip(self.stroke_layers.tolist(), self.stroke_frames.tolist(), self.stroke_ids.tolist())]
+
+    def read(self, gp, name, strokes = None):
+        # attribute of all selected points in one array
+        strokes = strokes or self.stroke_objects(gp)
+        values = [stroke_io.read_points(s.points, (name,))[name][mask] for s, mask in zip(strokes, self.masks)]
+        return np.concatenate(values) if values else stroke_io.empty_attribute(name, 0)
+
+    def write(self, gp, name, values, strokes = None):
+        # set the attribute of the selected points, one foreach_set per stroke
+        strokes = strokes or self.stroke_objects(gp)
+        for s, mask, start, end in zip(strokes, self.masks, self.offsets[:-1].tolist(), self.offsets[1:].tolist()):
+            data = stroke_io.read_points(s.points, (name,))[name]
+            data[mask] = values[start:end]
+            s.points.foreach_set(name, data.ravel())
+
+def query(context):
+    # cached Selection of the active object, None if it isn't grease pencil
+    ob = context.active_object
+    if ob is None or ob.type != 'GPENCIL':
+        return None
+
+    gp = ob.data
+    key = (ob.name, gp.name, context.scene.frame_current, gp.use_multiedit)
+    selection = selection_cache.get(key)
+    if selection is None:
+        selection = selection_cache[key] = Selection(gp)
+    return selection
+
+@persistent
+def selectionDepsgraphUpdate(scene, depsgraph):
+    # selection, stroke and layer edits all come through as updates of the
+    # object or its data
+    names = {update.id.name for update in depsgraph.updates}
+    for key in [key for key in selection_cache if key[0] in names or key[1] in names]:
+        del selection_cache[key]
+
+@persistent
+def selectionClear(*args):
+    selection_cache.clear()
+
+def register():
+    bpy.app.handlers.depsgraph_update_post.append(selectionDepsgraphUpdate)
+    bpy.app.handlers.undo_post.append(selectionClear)
+    bpy.app.handlers.redo_post.append(selectionClear)
+    bpy.app.handlers.load_post.append(selectionClear)
+
+def unregister():
+    for handlers, func in ( (bpy.app.handlers.depsgraph_update_post, selectionDepsgraphUpdate),
+        (bpy.app.handlers.undo_post, selectionClear), (bpy.app.handlers.redo_post, selectionClear),
+        (bpy.app.handlers.load_post, selectionClear) ):
+        if func in handlers:
+            handlers.remove(func)
+    selection_cache.clear()
@@ -0,0 +1,349 @@
+import math
+import numpy as np
+
+# Uniform grid spatial index. Keys are bucketed by every cell their bounding box
+# overlaps, so a bounding box query only has to look at the items near it.
+# Items that would cover more than MAX_ITEM_CELLS cells (a long diagonal edge
+# among short ones) are kept in a separate list that every query checks.
+
+MAX_ITEM_CELLS = 256
+
+def cell_size_for(bboxes, min_cells = 1024):
+    # pick a cell size close to the average item size, but never so small
+    # that the whole extent is split in more than min_cells^2 cells
+    if not bboxes:
+        return 1.0
+
+    minx = min(b[0] for b in bboxes)
+    miny = min(b[1] for b in bboxes)
+    maxx = max(b[2] for b in bboxes)
+    maxy = max(b[3] for b in bboxes)
+
+    avg = sum(max(b[2] - b[0], b[3] - b[1]) for b in bboxes) / len(bboxes)
+    extent = max(maxx - minx, maxy - miny)
+
+    size = max(avg, extent / min_cells)
+    return size if size > 0 else 1.0
+
+
+class UniformGrid:
+    def __init__(self, cell_size):
+        self.cell_size = cell_size if cell_size > 0 else 1.0
+        self.cells = {}
+        self.bounds = {}
+        self.oversized = set()
+
+    def __len__(self):
+        return len(self.bounds)
+
+    def __contains__(self, key):
+        return key in self.bounds
+
+    def cell_range(self, minx, miny, maxx, maxy):
+        s = self.cell_size
+        return (math.floor(minx / s), math.floor(miny / s), math.floor(maxx / s), math.floor(maxy / s))
+
+    def iter_cells(self, minx, miny, maxx, maxy):
+        x0, y0, x1, y1 = self.cell_range(minx, miny, maxx, maxy)
+        for cx in range(x0, x1 + 1):
+            for cy in range(y0, y1 + 1):
+                yield (cx, cy)
+
+    def cell_count(self, minx, miny, maxx, maxy):
+        x0, y0, x1, y1 = self.cell_range(minx, miny, maxx, maxy)
+        return (x1 - x0 + 1) * (y1 - y0 + 1)
+
+    def insert(self, key, minx, miny, maxx, maxy):
+        if key in self.bounds:
+            self.remove(key)
+        self.bounds[key] = (minx, miny, maxx, maxy)
+        if self.cell_count(minx, miny, maxx, maxy) > MAX_ITEM_CELLS:
+            self.oversized.add(key)
+            return
+        for cell in self.iter_cells(minx, miny, maxx, maxy):
+            bucket = self.cells.get(cell)
+            if bucket is None:
+                self.cells[cell] = bucket = []
+            bucket.append(key)
+
+    def remove(self, key):
+        bounds = self.bounds.pop(key, None)
+        if bounds is None:
+            return
+        if key in self.oversized:
+            self.oversized.remove(key)
+            return
+        for cell in self.iter_cells(*bounds):
+            bucket = self.cells.get(cell)
+            if bucket is None:
+                continue
+            bucket.remove(key)
+            if not bucket:
+                del self.cells[cell]
+
+    def query(self, minx, miny, maxx, maxy):
+        # keys whose bounding box overlaps the query box
+        found = set()
+        for key in self.oversized:
+            b = self.bounds[key]
+            if b[0] <= maxx and b[2] >= minx and b[1] <= maxy and b[3] >= miny:
+                found.add(key)
+
+        x0, y0, x1, y1 = self.cell_range(minx, miny, maxx, maxy)
+        if (x1 - x0 + 1) * (y1 - y0 + 1) > len(self.cells):
+            # query box covers more cells than are occupied, walk the occupied ones
+            buckets = [b for c, b in self.cells.items() if x0 <= c[0] <= x1 and y0 <= c[1] <= y1]
+        else:
+            buckets = [self.cells.get(c) for c in self.iter_cells(minx, miny, maxx, maxy)]
+        for bucket in buckets:
+            if bucket is None:
+                continue
+            for key in bucket:
+                if key in found:
+                    continue
+                b = self.bounds[key]
+                if b[0] <= maxx and b[2] >= minx and b[1] <= maxy and b[3] >= miny:
+                    found.add(key)
+        return found
+
+
+class SegmentIndex:
+    # Segments of many polylines (strokes). Segment i runs from point i to point
+    # i + 1 (wrapping for cyclic lines). Segments are grid indexed in chunks of
+    # CHUNK consecutive segments, a query then filters the segments of the
+    # chunks found by their own bounding boxes in one vectorized test.
+
+    CHUNK = 32
+
+    def __init__(self, cell_size):
+        self.grid = UniformGrid(cell_size)
+        self.lines = {} # key : (points (n, 2), segment bounds (m, 4))
+
+    @classmethod
+    def build(cls, lines):
+        # lines: { key : (points, cyclic) }
+        bounds = {key : cls.segment_bounds(points, cyclic) for key, (points, cyclic) in lines.items()}
+        chunks = {key : cls.chunk_bounds(b) for key, b in bounds.items()}
+        index = cls(cell_size_for( [c for line in chunks.values() for c in line] ))
+        for key, (points, cyclic) in lines.items():
+            index.insert(key, points, cyclic, bounds[key], chunks[key])
+        return index
+
+    @staticmethod
+    def segment_bounds(points, cyclic):
+        points = np.asarray(points, dtype=np.float64).reshape(-1, 2)
+        if len(points) < 2:
+            return np.empty( (0, 4) )
+        ends = np.roll(points, -1, axis=0) if cyclic else points[1:]
+        starts = points if cyclic else points[:-1]
+        return np.concatenate( (np.minimum(starts, ends), np.maximum(starts, ends)), axis=1)
+
+    @classmethod
+    def chunk_bounds(cls, bounds):
+        return [tuple(bounds[i:i + cls.CHUNK, :2].min(axis=0)) + tuple(bounds[i:i + cls.CHUNK, 2:].max(axis=0))
+            for i in range(0, len(bounds), cls.CHUNK)]
+
+    def __len__(self):
+        return len(self.lines)
+
+    def __contains__(self, key):
+        return key in self.lines
+
+    def insert(self, key, points, cyclic, bounds = None, chunks = None):
+        self.remove(key)
+        points = np.asarray(points, dtype=np.float64).reshape(-1, 2)
+        if bounds is None:
+            bounds = self.segment_bounds(points, cyclic)
+        if chunks is None:
+            chunks = self.chunk_bounds(bounds)
+        self.lines[key] = (points, bounds)
+        for chunk, b in enumerate(chunks):
+            self.grid.insert( (key, chunk), *b)
+
+    def remove(self, key):
+        line = self.lines.pop(key, None)
+        if line is None:
+            return
+        for chunk in range((len(line[1]) + self.CHUNK - 1) // self.CHUNK):
+            self.grid.remove( (key, chunk) )
+
+    def query(self, minx, miny, maxx, maxy):
+        # { key : sorted indices of the segments whose bounds overlap the box }
+        chunks = {}
+        for key, chunk in self.grid.query(minx, miny, maxx, maxy):
+            chunks.setdefault(key, []).append(chunk)
+
+        found = {}
+        for key, line_chunks in chunks.items():
+            bounds = self.lines[key][1]
+            segments = np.concatenate( [np.arange(c * self.CHUNK, min( (c + 1) * self.CHUNK, len(bounds))) for c in sorted(line_chunks)] )
+            b = bounds[segments]
+            hit = (b[:, 0] <= maxx) & (b[:, 2] >= minx) & (b[:, 1] <= maxy) & (b[:, 3] >= miny)
+            if hit.any():
+                found[key] = segments[hit]
+        return found
+
+    def query_boxes(self, boxes):
+        # query for each box, segment indices merged per key
+        found = {}
+        for box in boxes:
+            for key, segments in self.query(*box).items():
+                found[key] = np.union1d(found[key], segments) if key in found else segments
+        return found
+
+
+class StrokeSnapshots:
+    # Compact copies of the points of a set of strokes, keyed by content so
+    # strokes can be added and removed one at a time instead of snapshotting
+    # everything again. No references to the strokes themselves are kept.
+    # Segments are indexed in the x/z plane.
+
+    def __init__(self):
+        self.strokes = {}     # key : [reference count, co (n, 3), cyclic]
+        self.segments = None  # SegmentIndex, created with the first strokes
+        self.cached_points = None
+
+    def __len__(self):
+        return len(self.strokes)
+
+    def __contains__(self, key):
+        return key in self.strokes
+
+    def update(self, keys, snapshot):
+        # keys: content keys of all strokes now present (duplicates allowed)
+        # snapshot(key): (co, cyclic) of a stroke, only called for new strokes
+        counts = {}
+        for key in keys:
+            counts[key] = counts.get(key, 0) + 1
+
+        removed = [key for key in self.strokes if key not in counts]
+        for key in removed:
+            self.strokes[key][0] = 1
+            self.remove(key)
+
+        added = {key : snapshot(key) for key in counts if key not in self.strokes}
+        lines = {key : (np.asarray(co)[:, [0, 2]], cyclic) for key, (co, cyclic) in added.items() if len(co) > 1}
+        if self.segments is None and lines:
+            self.segments = SegmentIndex.build(lines)
+        for key, (co, cyclic) in added.items():
+            self.add(key, co, cyclic)
+
+        for key, count in counts.items():
+            self.strokes[key][0] = count
+
+        return len(added), len(removed)
+
+    def add(self, key, co, cyclic):
+        # returns True if the stroke is new, identical strokes share one entry
+        entry = self.strokes.get(key)
+        if entry:
+            entry[0] += 1
+            return False
+
+        co = np.array(co, dtype=np.float32).reshape(-1, 3)
+        self.strokes[key] = [1, co, cyclic]
+        if len(co) > 1:
+            xz = co[:, [0, 2]]
+            if self.segments is None:
+                self.segments = SegmentIndex(cell_size_for(SegmentIndex.chunk_bounds(SegmentIndex.segment_bounds(xz, cyclic))))
+            if key not in self.segments:
+                self.segments.insert(key, xz, cyclic)
+        self.cached_points = None
+        return True
+
+    def remove(self, key):
+        # drop one reference, returns True if the stroke is gone
+        entry = self.strokes.get(key)
+        if entry is None:
+            return False
+        entry[0] -= 1
+        if entry[0] > 0:
+            return False
+
+        del self.strokes[key]
+        if self.segments is not None:
+            self.segments.remove(key)
+        self.cached_points = None
+        return True
+
+    def line(self, key):
+        # (co, cyclic) of a stroke
+        entry = self.strokes[key]
+        return entry[1], entry[2]
+
+    def points(self):
+        # points of all strokes in one (n, 3) array, the same array object
+        # until strokes are added or removed
+        if self.cached_points is None:
+            co = [entry[1] for entry in self.strokes.values()]
+            self.cached_points = np.concatenate(co) if co else np.empty( (0, 3), dtype=np.float32)
+        return self.cached_points
+
+
+class PointGrid:
+    # Static 2D points bucketed by cell with a single sort, for nearest point
+    # queries within a radius (snapping). Rebuilt rather than updated. Only
+    # finite points inside bounds (minx, miny, maxx, maxy) are indexed, so
+    # projected points far off screen can't blow up the cell keys.
+
+    def __init__(self, points, cell_size, bounds = None):
+        self.cell_size = cell_size if cell_size > 0 else 1.0
+        self.points = np.asarray(points, dtype=np.float64).reshape(-1, 2)
+
+        keep = np.isfinite(self.points).all(axis=1)
+        if bounds is not None:
+            p = self.points
+            keep &= (p[:, 0] >= bounds[0]) & (p[:, 0] <= bounds[2]) & (p[:, 1] >= bounds[1]) & (p[:, 1] <= bounds[3])
+        kept = keep.nonzero()[0]
+
+        cells = np.floor(self.points[kept] / self.cell_size).astype(np.int64)
+        if len(cells):
+            self.origin = cells.min(axis=0)
+            self.shape = cells.max(axis=0) - self.origin + 1
+        else:
+            self.origin = np.zeros(2, dtype=np.int64)
+            self.shape = np.zeros(2, dtype=np.int64)
+
+        keys = self.cell_keys(cells)
+        order = np.argsort(keys, kind='stable')
+        self.order = kept[order]
+        self.keys = keys[order]
+
+    def __len__(self):
+        return len(self.points)
+
+    def cell_keys(self, cells):
+        cells = cells - self.origin
+        return cells[:, 0] * self.shape[1] + cells[:, 1]
+
+    def query(self, minx, miny, maxx, maxy):
+        # indices of the points inside the box
+        if len(self.points) == 0:
+            return np.empty(0, dtype=np.int64)
+
+        s = self.cell_size
+        x0, y0 = np.maximum( (math.floor(minx / s), math.floor(miny / s)), self.origin)
+        x1, y1 = np.minimum( (math.floor(maxx / s), math.floor(maxy / s)), self.origin + self.shape - 1)
+        if x0 > x1 or y0 > y1:
+            return np.empty(0, dtype=np.int64)
+
+        # each column of cells is one contiguous run of keys
+        columns = np.arange(x0, x1 + 1)
+        first = self.cell_keys(np.stack( (columns, np.full(len(columns), y0)), axis=1))
+        last = self.cell_keys(np.stack( (columns, np.full(len(columns), y1)), axis=1))
+        starts = np.searchsorted(self.keys, first, side='left')
+        ends = np.searchsorted(self.keys, last, side='right')
+
+        found = np.concatenate( [self.order[a:b] for a, b in zip(starts, ends)] ) if len(columns) else self.order[:0]
+        p = self.points[found]
+        inside = (p[:, 0] >= minx) & (p[:, 0] <= maxx) & (p[:, 1] >= miny) & (p[:, 1] <= maxy)
+        return found[inside]
+
+    def nearest(self, x, y, radius):
+        # index of the indexed point closest to (x, y) and closer than radius, or None
+        found = self.query(x - radius, y - radius, x + radius, y + radius)
+        if len(found) == 0:
+            return None
+        d = ( (self.points[found] - (x, y)) ** 2).sum(axis=1)
+        k = np.argmin(d)
+        return int(found[k]) if d[k] < radius * radius else None